@@ -1,48 +1,101 @@
 import os
-import re
-import json
+import shutil
+import asyncio
+import orjson
+import uuid
 import time
 import sys
-from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect
-from pydantic import BaseModel
+import atexit
+import queue
+import logging
+import logging.handlers
+from collections import OrderedDict
+from contextlib import asynccontextmanager
+from fastapi import FastAPI, HTTPException, WebSocket, WebSocketDisconnect, BackgroundTasks, Response
+from pydantic import BaseModel, ConfigDict, Json, ValidationError
 import uvicorn
 from fastapi.middleware.cors import CORSMiddleware
 
 # Import necessary functions from existing backend files
 from openai_api import (
-    generate_single_page_structure,
-    generate_image_from_prompt,
-    infer_characters,
+    agenerate_single_page_structure,
+    agenerate_image_from_prompt,
+    ainfer_characters,
     check_api_key,
     PROMPTS,
-    edit_image_from_prompt
+    aedit_image_from_prompt,
+    asubmit_image_batch,
+    await_image_batch,
+    create_async_http_client,
+    configure_async_client
 )
 from replicate_api import generate_image_with_replicate, check_replicate_api_key
-from utils import sanitize_filename # Assuming sanitize_filename is needed
+from utils import sanitize_filename, build_character_matcher, save_binary_file, downscale_image_for_edit, compile_prompt_template
+
+# --- Logging ---
+# Records are handed to a queue and written to stdout by a background thread,
+# so logging never blocks the event loop on console I/O.
+logger = logging.getLogger("skryb.api")
+
+def configure_logging(level=logging.INFO):
+    """
+    Attaches a QueueHandler to the api logger and starts the listener that writes its records.
+
+    Safe to call more than once: `python api.py` imports this module twice (as __main__ and
+    as "api" for uvicorn), and both share the logger, so only the first call sets it up.
+    """
+    if logger.handlers:
+        return
+    log_queue = queue.SimpleQueue()
+    stream_handler = logging.StreamHandler(sys.stdout)
+    stream_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(message)s"))
+    listener = logging.handlers.QueueListener(log_queue, stream_handler)
+    logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    logger.setLevel(level)
+    logger.propagate = False
+    listener.start()
+    atexit.register(listener.stop) # Flush any queued records on shutdown
+
+configure_logging()
 
 # Define a request body model
 class BookGenerationRequest(BaseModel):
+    # Requests are read-only once validated; unknown fields are dropped and text is trimmed
+    model_config = ConfigDict(extra='ignore', frozen=True, str_strip_whitespace=True)
+
     bookTitle: str
     selectedStyle: str
     numberOfPages: int
     quickMode: bool
-    characterDescriptions: str | None = None # Optional for Quick Mode
+    # Optional for Quick Mode. The frontend sends a JSON-encoded object; a plain object is accepted too
+    characterDescriptions: Json[dict[str, str]] | dict[str, str] | None = None
     storyOutline: str
     useExperimentalConsistency: bool
     modelSelection: str
     referenceImage: str | None = None
     safetyTolerance: int | None = None
-
-app = FastAPI()
-
-# Add CORS middleware
-app.add_middleware(
-    CORSMiddleware,
-    allow_origins=["http://localhost:5173"],  # Allow requests from your Vue frontend
-    allow_credentials=True,
-    allow_methods=["*"],  # Allow all methods (OPTIONS, POST, etc.)
-    allow_headers=["*"],  # Allow all headers
-)
+    useBatchApi: bool = False # Submit page images as one OpenAI batch (slower, cheaper)
+
+@asynccontextmanager
+async def lifespan(app: FastAPI):
+    """Shares one pooled HTTP/2 client between all OpenAI calls for the server's lifetime."""
+    async with create_async_http_client() as http_client:
+        configure_async_client(http_client)
+        yield
+
+app = FastAPI(lifespan=lifespan)
+
+# Add CORS middleware. Origins come from CORS_ALLOW_ORIGINS (comma-separated); set it to
+# an empty string when a reverse proxy already handles CORS to skip the middleware entirely.
+CORS_ALLOW_ORIGINS = [origin.strip() for origin in os.getenv("CORS_ALLOW_ORIGINS", "http://localhost:5173").split(",") if origin.strip()]
+if CORS_ALLOW_ORIGINS:
+    app.add_middleware(
+        CORSMiddleware,
+        allow_origins=CORS_ALLOW_ORIGINS,  # Allow requests from your Vue frontend
+        allow_credentials=True,
+        allow_methods=["GET", "POST", "OPTIONS"],  # Only the methods the API exposes
+        allow_headers=["content-type", "authorization"],
+    )
 
 def get_available_styles():
     """Reads prompts.json and returns a list of available illustration styles."""
@@ -50,324 +103,545 @@ def get_available_styles():
     # Fallback to prompts_example.json if prompts.json doesn't exist
     prompts_file = 'prompts.json' if os.path.exists('prompts.json') else 'prompts_example.json'
     try:
-        with open(prompts_file, 'r') as f:
-            prompts_data = json.load(f)
+        with open(prompts_file, 'rb') as f:
+            prompts_data = orjson.loads(f.read())
         for key, value in prompts_data.items():
             if key.startswith("stage2_image_"):
                 # Attempt to get a description from the prompt, otherwise generate one
                 desc = value.get("description", "Custom Style")
                 styles.append({"key": key, "desc": desc})
-    except (FileNotFoundError, json.JSONDecodeError) as e:
-        print(f"Error reading or parsing {prompts_file}: {e}")
+    except (FileNotFoundError, orjson.JSONDecodeError) as e:
+        logger.error(f"Error reading or parsing {prompts_file}: {e}")
         # Provide a default style as a fallback
         return [{"key": "stage2_image_childrens", "desc": "Default Dreamy Childrens Book"}]
     return styles
 
+# Encoded style list served by /api/styles as (prompts file, mtime_ns, JSON bytes)
+_styles_cache = None
+
+def get_available_styles_json():
+    """Returns the encoded style list, re-reading the prompts file only when it has changed."""
+    global _styles_cache
+    prompts_file = 'prompts.json' if os.path.exists('prompts.json') else 'prompts_example.json'
+    try:
+        mtime_ns = os.stat(prompts_file).st_mtime_ns
+    except OSError:
+        mtime_ns = None
+    if _styles_cache is None or _styles_cache[:2] != (prompts_file, mtime_ns):
+        _styles_cache = (prompts_file, mtime_ns, orjson.dumps(get_available_styles()))
+    return _styles_cache[2]
+
 @app.get("/api/styles")
 async def get_styles():
     """API endpoint to get the list of available illustration styles."""
-    return get_available_styles()
-
-@app.websocket("/ws/generate-progress")
-async def websocket_endpoint(websocket: WebSocket):
-    await websocket.accept()
-    print("WebSocket connection accepted.")
-    try:
-        # Receive the book generation parameters from the frontend
-        data = await websocket.receive_text()
-        request = BookGenerationRequest.model_validate_json(data) # Use model_validate_json for Pydantic v2+
+    # Served pre-encoded, so repeat requests skip the file read, parse and jsonable_encoder
+    return Response(content=get_available_styles_json(), media_type="application/json")
+
+# Page text field Stage 1 returns for each story type
+STAGE1_TEXT_KEYS = {"childrens": "page_text", "narrative": "script_text"}
+
+def resolve_style_type(key, prompt):
+    """Returns a style's story type: its "style_type" entry in prompts.json, else guessed from the key."""
+    if isinstance(prompt, dict) and prompt.get("style_type") in STAGE1_TEXT_KEYS:
+        return prompt["style_type"]
+    return "narrative" if "narrative" in key.lower() else "childrens"
+
+# Story type for each prompt key, resolved once at startup so requests only do a lookup
+STYLE_TYPES = {key: resolve_style_type(key, prompt) for key, prompt in (PROMPTS or {}).items()}
+
+# Maximum number of page illustrations rendered at the same time. Pages only run
+# concurrently when Experimental Consistency Mode is off, since that mode edits
+# the previous page's image.
+PAGE_IMAGE_CONCURRENCY = 5
+
+async def render_page_image(notify, request, book_dir, page_num, image_prompt, previous_page_image_path, semaphore):
+    """
+    Generates (or edits) the illustration for a single page and saves it to the book directory.
+
+    OpenAI calls are awaited directly; the blocking Replicate helper runs in a worker
+    thread so the event loop stays free while several pages are in flight.
+
+    Returns:
+        str or None: The path of the saved illustration if successful, otherwise None.
+    """
+    async with semaphore:
+        image_data = None
+        error2 = None
+
+        if request.modelSelection == 'replicate':
+            logger.info(f"--- Using Replicate Image Generation for Page {page_num} ---")
+            image_data, error2 = await asyncio.to_thread(
+                generate_image_with_replicate,
+                prompt_text=image_prompt,
+                input_image=request.referenceImage,
+                safety_tolerance=request.safetyTolerance
+            )
+            if error2:
+                logger.error(f"Error during Replicate image generation for page {page_num}: {error2}")
+                await notify({"status": "warning", "message": f"Replicate image generation failed for page {page_num}: {error2}. Skipping image."})
+                image_data = None
+        elif request.useExperimentalConsistency and page_num > 0 and previous_page_image_path:
+            logger.info(f"--- Using Image Editing for Page {page_num} ---")
+            try:
+                # A smaller reference uploads faster; retries within the edit call reuse these bytes
+                edit_input = await asyncio.to_thread(downscale_image_for_edit, previous_page_image_path)
+            except OSError as e:
+                logger.warning(f"Could not downscale {previous_page_image_path} for editing: {e}. Uploading it as is.")
+                edit_input = previous_page_image_path
+            image_data, error2 = await aedit_image_from_prompt(
+                edit_input,
+                prompt_text=image_prompt,
+                size="1536x1024",
+                quality="high"
+            )
+            if error2:
+                 logger.error(f"Error during image editing for page {page_num}: {error2}")
+                 await notify({"status": "warning", "message": f"Image editing failed for page {page_num}: {error2}. Falling back to standard generation."})
+                 logger.info("Falling back to standard generation...")
+                 image_data, error2 = await agenerate_image_from_prompt(
+                     prompt_text=image_prompt,
+                     size="1536x1024",
+                     quality="high"
+                 )
+                 if error2:
+                      logger.error(f"Error during fallback standard generation for page {page_num}: {error2}")
+                      await notify({"status": "warning", "message": f"Standard generation also failed for page {page_num}: {error2}. Skipping image."})
+                      image_data = None
 
-        print("Received book generation request via WebSocket:")
-        print(f"  Book Title: {request.bookTitle}")
-        print(f"  Selected Style: {request.selectedStyle}")
-        print(f"  Number of Pages: {request.numberOfPages}")
-        print(f"  Quick Mode: {request.quickMode}")
-        if not request.quickMode:
-            print(f"  Character Descriptions: {request.characterDescriptions}")
-        print(f"  Story Outline: {request.storyOutline}")
-        print(f"  Use Experimental Consistency: {request.useExperimentalConsistency}")
-
-        # --- Adapt Logic from create_book.py main function ---
-
-        # Check API Key and Prompts
-        if request.modelSelection == 'openai' and not check_api_key():
-            await websocket.send_text(json.dumps({"status": "error", "message": "OpenAI API key not configured."}))
-            return
-        if request.modelSelection == 'replicate' and not check_replicate_api_key():
-            await websocket.send_text(json.dumps({"status": "error", "message": "Replicate API key not configured."}))
-            return
-        if not PROMPTS:
-            await websocket.send_text(json.dumps({"status": "error", "message": "Could not load prompts from prompts.json."}))
-            return
-
-        # Get chosen style details (assuming selectedStyle from frontend matches a key in PROMPTS)
-        style_type = "childrens" # Default
-        if "narrative" in request.selectedStyle.lower():
-            style_type = "narrative"
-
-        # Infer Characters if in Quick Mode
-        characters = {}
-        if request.quickMode:
-            await websocket.send_text(json.dumps({"status": "progress", "message": "Quick Mode: Inferring characters from story concept..."}))
-            inferred_chars, char_error = infer_characters(request.storyOutline)
-            if char_error:
-                await websocket.send_text(json.dumps({"status": "error", "message": f"Error inferring characters: {char_error}"}))
-                return
-            if not inferred_chars:
-                 await websocket.send_text(json.dumps({"status": "error", "message": "Could not infer characters from the concept."}))
-                 return
-            characters = inferred_chars
-            print("Inferred Characters:", characters)
-            await websocket.send_text(json.dumps({"status": "progress", "message": "Characters inferred successfully."}))
         else:
-            if request.characterDescriptions:
-                try:
-                    characters = json.loads(request.characterDescriptions)
-                    if not isinstance(characters, dict):
-                         raise ValueError("Character descriptions must be a JSON object.")
-                except (json.JSONDecodeError, ValueError) as e:
-                    await websocket.send_text(json.dumps({"status": "error", "message": f"Invalid character descriptions JSON: {e}"}))
-                    return
-            if not characters:
-                 await websocket.send_text(json.dumps({"status": "error", "message": "Character descriptions are required in Full Mode."}))
-                 return
-
-
-        # Setup Output Directory
-        sanitized_title = sanitize_filename(request.bookTitle)
-        book_dir = os.path.join("output_books", sanitized_title)
+            logger.info(f"--- Using Standard Image Generation for Page {page_num} ---")
+            image_data, error2 = await agenerate_image_from_prompt(
+                prompt_text=image_prompt,
+                size="1536x1024",
+                quality="high"
+            )
+            if error2:
+                 logger.error(f"Error during standard image generation for page {page_num}: {error2}")
+                 await notify({"status": "warning", "message": f"Image generation failed for page {page_num}: {error2}. Skipping image."})
+                 image_data = None
 
+
+        # Save Image (if successful)
+        if image_data:
+            output_filename = os.path.join(book_dir, f"page_{page_num:02d}.png")
+            try:
+                # Write in a worker thread so other pages' API calls keep flowing
+                await asyncio.to_thread(save_binary_file, output_filename, image_data)
+                logger.info(f"--- Stage 2 Success: Page {page_num} image saved successfully as {output_filename} ---")
+                await notify({"status": "progress", "message": f"Page {page_num}: Illustration saved."})
+            except IOError as e:
+                logger.error(f"Error saving image {output_filename}: {e}")
+                await notify({"status": "warning", "message": f"Error saving image for page {page_num}: {e}. Continuing."})
+                return None
+            return output_filename
+
+        return None
+
+def validate_book_request(request: BookGenerationRequest):
+    """
+    Checks a request against the loaded prompts before any API calls are made.
+
+    Returns:
+        str or None: An error message if the request cannot be generated, otherwise None.
+    """
+    if not PROMPTS:
+        return "Could not load prompts from prompts.json."
+    if not PROMPTS.get(request.selectedStyle, {}).get('prompt_template'):
+        return f"Image prompt template '{request.selectedStyle}' not found in prompts.json."
+    if not request.quickMode and not request.characterDescriptions:
+        return "Character descriptions are required in Full Mode."
+    return None
+
+async def render_chained_page_image(notify, request, book_dir, page_num, image_prompt, previous_image_task, semaphore):
+    """
+    Renders a consistency-mode page once the illustration it edits is ready.
+
+    Returns:
+        str or None: This page's image path, or the previous one if this page failed,
+        so the next page continues from the last successful illustration.
+    """
+    previous_page_image_path = await previous_image_task
+    image_path = await render_page_image(
+        notify, request, book_dir, page_num, image_prompt, previous_page_image_path, semaphore
+    )
+    return image_path or previous_page_image_path
+
+async def copy_page_image(notify, book_dir, page_num, source_image_task):
+    """
+    Saves a copy of another page's illustration for a page with the identical image prompt.
+
+    Returns:
+        str or None: The path of the copied illustration, or None if the source page has none.
+    """
+    source_path = await source_image_task
+    if not source_path:
+        await notify({"status": "warning", "message": f"No illustration to reuse for page {page_num}. Skipping image."})
+        return None
+
+    output_filename = os.path.join(book_dir, f"page_{page_num:02d}.png")
+    try:
+        await asyncio.to_thread(shutil.copyfile, source_path, output_filename)
+    except OSError as e:
+        logger.error(f"Error copying image {source_path} to {output_filename}: {e}")
+        await notify({"status": "warning", "message": f"Error saving image for page {page_num}: {e}. Continuing."})
+        return None
+    logger.info(f"--- Stage 2 Success: Page {page_num} reuses {source_path} as {output_filename} ---")
+    await notify({"status": "progress", "message": f"Page {page_num}: Illustration saved."})
+    return output_filename
+
+async def render_batched_page_images(notify, book_dir, page_prompts):
+    """
+    Renders every page illustration through a single OpenAI Batch API job.
+
+    Args:
+        notify (callable): An async callable that receives each status message as a dict.
+        book_dir (str): The directory the page images are saved to.
+        page_prompts (dict): Maps page numbers to their image prompts.
+    """
+    # Identical prompts are submitted once; every page using one saves its image
+    first_page_by_prompt = {}
+    for page_num, prompt in page_prompts.items():
+        first_page_by_prompt.setdefault(prompt, page_num)
+
+    await notify({"status": "progress", "message": f"Submitting {len(first_page_by_prompt)} page illustrations as a batch..."})
+    batch_id, batch_error = await asubmit_image_batch(
+        {f"page_{page_num:02d}": prompt for prompt, page_num in first_page_by_prompt.items()},
+        size="1536x1024",
+        quality="high"
+    )
+    if batch_error:
+        await notify({"status": "warning", "message": f"Image batch submission failed: {batch_error}. Skipping page images."})
+        return
+
+    await notify({"status": "progress", "message": f"Image batch {batch_id} submitted. Waiting for it to complete (this can take a while)..."})
+    results, batch_error = await await_image_batch(batch_id)
+    if batch_error:
+        await notify({"status": "warning", "message": f"Image batch failed: {batch_error}. Skipping page images."})
+        return
+
+    for page_num, prompt in page_prompts.items():
+        image_data, error2 = results.get(f"page_{first_page_by_prompt[prompt]:02d}", (None, "No result returned for this page."))
+        if error2 or not image_data:
+            await notify({"status": "warning", "message": f"Image generation failed for page {page_num}: {error2}. Skipping image."})
+            continue
+
+        output_filename = os.path.join(book_dir, f"page_{page_num:02d}.png")
         try:
-            os.makedirs(book_dir, exist_ok=True)
-            print(f"Output directory: {book_dir}")
-            await websocket.send_text(json.dumps({"status": "progress", "message": f"Output directory created at: {book_dir}"}))
-        except OSError as e:
-            await websocket.send_text(json.dumps({"status": "error", "message": f"Error creating directory {book_dir}: {e}"}))
-            return
-
-        # --- Generate Cover Image ---
-        await websocket.send_text(json.dumps({"status": "progress", "message": "Generating book cover..."}))
-        cover_image_data = None
-        try:
-            cover_template = PROMPTS.get('cover_image_generation', {}).get('prompt_template')
-            if not cover_template:
-                 print("Warning: Cover image generation template not found. Skipping cover.")
-                 await websocket.send_text(json.dumps({"status": "warning", "message": "Cover template missing, skipping cover image."}))
+            await asyncio.to_thread(save_binary_file, output_filename, image_data)
+            logger.info(f"--- Stage 2 Success: Page {page_num} image saved successfully as {output_filename} ---")
+            await notify({"status": "progress", "message": f"Page {page_num}: Illustration saved."})
+        except IOError as e:
+            logger.error(f"Error saving image {output_filename}: {e}")
+            await notify({"status": "warning", "message": f"Error saving image for page {page_num}: {e}. Continuing."})
+
+async def generate_cover(notify, request, book_dir, char_detail_lines):
+    """
+    Generates the book cover from the title and every character's details and saves it.
+
+    Returns:
+        str or None: The path of the saved cover if successful, otherwise None.
+    """
+    await notify({"status": "progress", "message": "Generating book cover..."})
+    cover_image_data = None
+    cover_image_path = None
+    try:
+        cover_template = PROMPTS.get('cover_image_generation', {}).get('prompt_template')
+        if not cover_template:
+             logger.warning("Cover image generation template not found. Skipping cover.")
+             await notify({"status": "warning", "message": "Cover template missing, skipping cover image."})
+        else:
+            all_char_details_string = "\n".join(char_detail_lines.values())
+            cover_prompt = cover_template.format(
+                character_details_string=all_char_details_string,
+                book_title=request.bookTitle,
+                style_description=request.selectedStyle
+            )
+            if request.modelSelection == 'replicate':
+                cover_image_data, cover_error = await asyncio.to_thread(
+                    generate_image_with_replicate,
+                    prompt_text=cover_prompt,
+                    input_image=request.referenceImage,
+                    safety_tolerance=request.safetyTolerance
+                )
             else:
-                all_char_details_string = "\n".join([f"- {name}: {desc}" for name, desc in characters.items()])
-                cover_prompt = cover_template.format(
-                    character_details_string=all_char_details_string,
-                    book_title=request.bookTitle,
-                    style_description=request.selectedStyle
+                cover_image_data, cover_error = await agenerate_image_from_prompt(
+                    prompt_text=cover_prompt,
+                    size="1536x1024",
+                    quality="high"
                 )
-                if request.modelSelection == 'replicate':
-                    cover_image_data, cover_error = generate_image_with_replicate(
-                        prompt_text=cover_prompt,
-                        input_image=request.referenceImage,
-                        safety_tolerance=request.safetyTolerance
-                    )
-                else:
-                    cover_image_data, cover_error = generate_image_from_prompt(
-                        prompt_text=cover_prompt,
-                        size="1536x1024",
-                        quality="high"
-                    )
-                if cover_error:
-                    print(f"Error generating cover image: {cover_error}")
-                    await websocket.send_text(json.dumps({"status": "warning", "message": f"Error generating cover: {cover_error}. Skipping cover."}))
-                    cover_image_data = None
-                elif cover_image_data:
-                     cover_filename = os.path.join(book_dir, "cover.png")
-                     try:
-                         with open(cover_filename, "wb") as f:
-                             f.write(cover_image_data)
-                         print(f"Cover image saved successfully as {cover_filename}")
-                         await websocket.send_text(json.dumps({"status": "progress", "message": "Book cover saved successfully."}))
-                     except IOError as e:
-                         print(f"Error saving cover image {cover_filename}: {e}")
-                         await websocket.send_text(json.dumps({"status": "warning", "message": f"Error saving cover: {e}. Continuing."}))
-
-
-        except Exception as e:
-            print(f"An unexpected error occurred during cover generation: {e}")
-            await websocket.send_text(json.dumps({"status": "warning", "message": f"Unexpected error during cover generation: {e}. Skipping cover."}))
+            if cover_error:
+                logger.error(f"Error generating cover image: {cover_error}")
+                await notify({"status": "warning", "message": f"Error generating cover: {cover_error}. Skipping cover."})
+                cover_image_data = None
+            elif cover_image_data:
+                 cover_filename = os.path.join(book_dir, "cover.png")
+                 try:
+                     await asyncio.to_thread(save_binary_file, cover_filename, cover_image_data)
+                     cover_image_path = cover_filename
+                     logger.info(f"Cover image saved successfully as {cover_filename}")
+                     await notify({"status": "progress", "message": "Book cover saved successfully."})
+                 except IOError as e:
+                     logger.error(f"Error saving cover image {cover_filename}: {e}")
+                     await notify({"status": "warning", "message": f"Error saving cover: {e}. Continuing."})
+
 
+    except Exception as e:
+        logger.error(f"An unexpected error occurred during cover generation: {e}")
+        await notify({"status": "warning", "message": f"Unexpected error during cover generation: {e}. Skipping cover."})
+
+    return cover_image_path
+
+async def prepare_characters(request: BookGenerationRequest, notify) -> dict[str, str] | None:
+    """
+    Returns the book's characters, inferring them from the story concept in Quick Mode.
+
+    Returns:
+        dict or None: Character names mapped to descriptions, or None (after reporting the error) on failure.
+    """
+    if not request.quickMode:
+        # Already parsed and validated as a name -> description mapping by the request model
+        return dict(request.characterDescriptions)
+
+    await notify({"status": "progress", "message": "Quick Mode: Inferring characters from story concept..."})
+    inferred_chars, char_error = await ainfer_characters(request.storyOutline)
+    if char_error:
+        await notify({"status": "error", "message": f"Error inferring characters: {char_error}"})
+        return None
+    if not inferred_chars:
+         await notify({"status": "error", "message": "Could not infer characters from the concept."})
+         return None
+    logger.info(f"Inferred Characters: {inferred_chars}")
+    await notify({"status": "progress", "message": "Characters inferred successfully."})
+    return inferred_chars
+
+async def resolve_page_template(request: BookGenerationRequest, notify) -> str:
+    """Returns the page image template, using the style's edit template if consistency is on and one exists."""
+    if request.useExperimentalConsistency:
+        edit_template = PROMPTS.get(f"{request.selectedStyle}_edit", {}).get('prompt_template')
+        if edit_template:
+            return edit_template
+        logger.warning(f"Edit template '{request.selectedStyle}_edit' not found. Falling back to standard.")
+        await notify({"status": "warning", "message": "Edit template missing, falling back to standard generation."})
+    # selectedStyle's template was checked by validate_book_request
+    return PROMPTS[request.selectedStyle]['prompt_template']
+
+async def generate_page_structure(notify, request: BookGenerationRequest, characters: dict[str, str], page_num: int,
+                                  message_history: list, style_type: str, text_key: str) -> tuple[dict | None, list]:
+    """
+    Runs Stage 1 for one page.
+
+    Returns:
+        dict or None: The page's structure, or None (after reporting a warning) if the page should be skipped.
+        list: The updated message history to pass to the next page.
+    """
+    logger.info(f"--- Running Stage 1: Generating Structure for Page {page_num}... ---")
+    page_data, message_history, error1 = await agenerate_single_page_structure(
+        characters, request.storyOutline, page_num, message_history, request.numberOfPages, style_type=style_type
+    )
+
+    if error1:
+        logger.error(f"Error generating structure for page {page_num}: {error1}")
+        await notify({"status": "warning", "message": f"Error generating structure for page {page_num}: {error1}. Skipping image."})
+        return None, message_history
+    if not page_data:
+        logger.error(f"Failed to generate structure for page {page_num} (no error message).")
+        await notify({"status": "warning", "message": f"Failed to generate structure for page {page_num}. Skipping image."})
+        return None, message_history
+    if not page_data.get(text_key):
+         logger.warning(f"No '{text_key}' found in Stage 1 output for page {page_num}.")
+         await notify({"status": "warning", "message": f"No text found for page {page_num}. Skipping image."})
+         return None, message_history
+
+    logger.info(f"--- Stage 1 Success for Page {page_num}. ---")
+    await notify({"status": "progress", "message": f"Page {page_num}: Story content generated."})
+    return page_data, message_history
+
+def build_page_image_prompt(fill_image_prompt, page_data: dict, text_key: str,
+                            char_detail_lines: dict[str, str], find_mentioned_characters) -> str:
+    """Fills the page image template with the scene, the characters it mentions and the page text."""
+    scene_desc = page_data.get("scene_description", "")
+    char_details_string = "\n".join([char_detail_lines[name] for name in find_mentioned_characters(scene_desc)])
+    if not char_details_string:
+         char_details_string = "(No specific characters mentioned in scene description)"
+
+    # Text fields this style never produces are filled with "" (the template uses only one)
+    text_values = {key: "" for key in STAGE1_TEXT_KEYS.values()}
+    text_values[text_key] = page_data[text_key]
+    return fill_image_prompt(
+        scene_description=scene_desc,
+        character_details_string=char_details_string,
+        **text_values
+    )
+
+async def generate_book(request: BookGenerationRequest, notify) -> None:
+    """
+    Runs the full book generation for a request, reporting progress through notify.
+
+    Args:
+        request (BookGenerationRequest): The validated generation parameters.
+        notify (callable): An async callable that receives each status message as a dict.
+    """
+    # Validate the request and check API keys before spending any API calls
+    validation_error = validate_book_request(request)
+    if validation_error:
+        await notify({"status": "error", "message": validation_error})
+        return
+    if request.modelSelection == 'openai' and not check_api_key():
+        await notify({"status": "error", "message": "OpenAI API key not configured."})
+        return
+    if request.modelSelection == 'replicate' and not check_replicate_api_key():
+        await notify({"status": "error", "message": "Replicate API key not configured."})
+        return
+
+    # Get chosen style details (selectedStyle was checked against PROMPTS above)
+    style_type = STYLE_TYPES[request.selectedStyle]
+    text_key = STAGE1_TEXT_KEYS[style_type]
+
+    characters = await prepare_characters(request, notify)
+    if characters is None:
+        return
+
+    # Setup Output Directory
+    book_dir = os.path.join("output_books", sanitize_filename(request.bookTitle))
+    try:
+        await asyncio.to_thread(os.makedirs, book_dir, exist_ok=True)
+        logger.info(f"Output directory: {book_dir}")
+        await notify({"status": "progress", "message": f"Output directory created at: {book_dir}"})
+    except OSError as e:
+        await notify({"status": "error", "message": f"Error creating directory {book_dir}: {e}"})
+        return
+
+    # Format each character's details once; the cover and every page reuse these lines
+    char_detail_lines = {name: f"- {name}: {desc}" for name, desc in characters.items()}
+    find_mentioned_characters = build_character_matcher(characters)
+
+    image_tasks = []
+    # Identical prompts are rendered once; later pages with the same prompt copy that image
+    image_tasks_by_prompt = {}
+
+    # --- Generate Cover Image ---
+    # The cover only needs the title and characters, so it renders while Stage 1 writes the first pages
+    cover_task = asyncio.create_task(generate_cover(notify, request, book_dir, char_detail_lines))
+    try:
+        # Parsed once here; each page then only joins its values into the template
+        fill_image_prompt = compile_prompt_template(await resolve_page_template(request, notify))
 
         # --- Loop through pages ---
         message_history = []
-        previous_page_image_data = cover_image_data
+        # In consistency mode each page's render task waits on the one before it (starting
+        # with the cover); only saved file paths are passed along, the edit call reads from disk
+        previous_image_task = cover_task
+        page_semaphore = asyncio.Semaphore(PAGE_IMAGE_CONCURRENCY)
+        # Batch submission only applies to independent OpenAI pages
+        use_batch = request.useBatchApi and request.modelSelection == 'openai' and not request.useExperimentalConsistency
+        batch_page_prompts = {}
 
         for page_num in range(1, request.numberOfPages + 1):
             progress_percent = int((page_num / request.numberOfPages) * 100)
-            await websocket.send_text(json.dumps({"status": "progress", "message": f"Processing Page {page_num}/{request.numberOfPages}", "percent": progress_percent}))
-            print(f"\n===== Processing Page {page_num}/{request.numberOfPages} =====")
+            await notify({"status": "progress", "message": f"Processing Page {page_num}/{request.numberOfPages}", "percent": progress_percent})
+            logger.info(f"===== Processing Page {page_num}/{request.numberOfPages} =====")
 
             # --- Stage 1: Generate Single Page Structure ---
-            print(f"--- Running Stage 1: Generating Structure for Page {page_num}... ---")
-            page_data, message_history, error1 = generate_single_page_structure(
-                characters, request.storyOutline, page_num, message_history, request.numberOfPages, style_type=style_type
+            page_data, message_history = await generate_page_structure(
+                notify, request, characters, page_num, message_history, style_type, text_key
             )
-
-            if error1:
-                print(f"\nError generating structure for page {page_num}: {error1}")
-                await websocket.send_text(json.dumps({"status": "warning", "message": f"Error generating structure for page {page_num}: {error1}. Skipping image."}))
-                continue
-            if not page_data:
-                print(f"\nFailed to generate structure for page {page_num} (no error message).")
-                await websocket.send_text(json.dumps({"status": "warning", "message": f"Failed to generate structure for page {page_num}. Skipping image."}))
+            if page_data is None:
                 continue
 
-            scene_desc = page_data.get("scene_description", "")
-            if style_type == "narrative":
-                page_content_text = page_data.get("script_text", "")
-                text_key_for_image = "script_text"
-            else:
-                page_content_text = page_data.get("page_text", "")
-                text_key_for_image = "page_text"
-
-            if not page_content_text:
-                 print(f"Warning: No '{text_key_for_image}' found in Stage 1 output for page {page_num}.")
-                 await websocket.send_text(json.dumps({"status": "warning", "message": f"No text found for page {page_num}. Skipping image."}))
-                 continue
-
-
-            print(f"--- Stage 1 Success for Page {page_num}. ---")
-            await websocket.send_text(json.dumps({"status": "progress", "message": f"Page {page_num}: Story content generated."}))
-
-
             # --- Stage 2: Generate or Edit Image ---
-            await websocket.send_text(json.dumps({"status": "progress", "message": f"Page {page_num}: Generating illustration..."}))
-            print(f"--- Running Stage 2: Generating/Editing Image for Page {page_num}... ---")
-
-            mentioned_chars = {
-                name: desc for name, desc in characters.items()
-                if name.lower() in scene_desc.lower()
-            }
-            char_details_string = "\n".join([f"- {name}: {desc}" for name, desc in mentioned_chars.items()])
-            if not char_details_string:
-                 char_details_string = "(No specific characters mentioned in scene description)"
-
-            image_prompt = None
-            error2 = None
-            img_prompt_template = None
-            prompt_template_key = None
-
+            await notify({"status": "progress", "message": f"Page {page_num}: Generating illustration..."})
+            logger.info(f"--- Running Stage 2: Generating/Editing Image for Page {page_num}... ---")
             try:
-                prompt_template_key = request.selectedStyle
-                if request.useExperimentalConsistency and page_num > 0: # Use edit template for page 1+ if consistency is on
-                     prompt_template_key = f"{request.selectedStyle}_edit"
-                     if prompt_template_key not in PROMPTS:
-                          print(f"Warning: Edit template '{prompt_template_key}' not found. Falling back to standard.")
-                          await websocket.send_text(json.dumps({"status": "warning", "message": f"Edit template missing for page {page_num}, falling back to standard generation."}))
-                          prompt_template_key = request.selectedStyle
-
-
-                img_prompt_template = PROMPTS.get(prompt_template_key, {}).get('prompt_template')
-
-                if not img_prompt_template:
-                     raise KeyError(f"Image prompt template '{prompt_template_key}' not found in prompts.json")
-
-
-                image_prompt = img_prompt_template.format(
-                    scene_description=scene_desc,
-                    character_details_string=char_details_string,
-                    page_text=page_content_text if text_key_for_image == "page_text" else "",
-                    script_text=page_content_text if text_key_for_image == "script_text" else ""
+                image_prompt = build_page_image_prompt(
+                    fill_image_prompt, page_data, text_key, char_detail_lines, find_mentioned_characters
                 )
-            except KeyError as e:
-                print(f"Error accessing image prompt template or formatting for page {page_num}: {e}")
-                await websocket.send_text(json.dumps({"status": "warning", "message": f"Error formatting image prompt for page {page_num}: {e}. Skipping image."}))
-                continue
             except Exception as e:
-                 print(f"Error formatting image prompt for page {page_num}: {e}")
-                 await websocket.send_text(json.dumps({"status": "warning", "message": f"Error formatting image prompt for page {page_num}: {e}. Skipping image."}))
+                 logger.error(f"Error formatting image prompt for page {page_num}: {e}")
+                 await notify({"status": "warning", "message": f"Error formatting image prompt for page {page_num}: {e}. Skipping image."})
                  continue
 
-
-            image_data = None
-            error2 = None
-
-            if request.modelSelection == 'replicate':
-                print(f"--- Using Replicate Image Generation for Page {page_num} ---")
-                image_data, error2 = generate_image_with_replicate(
-                    prompt_text=image_prompt,
-                    input_image=request.referenceImage,
-                    safety_tolerance=request.safetyTolerance
-                )
-                if error2:
-                    print(f"Error during Replicate image generation for page {page_num}: {error2}")
-                    await websocket.send_text(json.dumps({"status": "warning", "message": f"Replicate image generation failed for page {page_num}: {error2}. Skipping image."}))
-                    image_data = None
-            elif request.useExperimentalConsistency and page_num > 0 and previous_page_image_data:
-                print(f"--- Using Image Editing for Page {page_num} ---")
-                image_data, error2 = edit_image_from_prompt(
-                    previous_page_image_data,
-                    prompt_text=image_prompt,
-                    size="1536x1024",
-                    quality="high"
-                )
-                if error2:
-                     print(f"Error during image editing for page {page_num}: {error2}")
-                     await websocket.send_text(json.dumps({"status": "warning", "message": f"Image editing failed for page {page_num}: {error2}. Falling back to standard generation."}))
-                     print("Falling back to standard generation...")
-                     image_data, error2 = generate_image_from_prompt(
-                         prompt_text=image_prompt,
-                         size="1536x1024",
-                         quality="high"
-                     )
-                     if error2:
-                          print(f"Error during fallback standard generation for page {page_num}: {error2}")
-                          await websocket.send_text(json.dumps({"status": "warning", "message": f"Standard generation also failed for page {page_num}: {error2}. Skipping image."}))
-                          image_data = None
-
+            if request.useExperimentalConsistency:
+                # Images render in page order, but Stage 1 moves on to the next page meanwhile
+                previous_image_task = asyncio.create_task(render_chained_page_image(
+                    notify, request, book_dir, page_num, image_prompt, previous_image_task, page_semaphore
+                ))
+                image_tasks.append(previous_image_task)
+            elif use_batch:
+                # Collected here and submitted together once every page has its prompt
+                batch_page_prompts[page_num] = image_prompt
+            elif image_prompt in image_tasks_by_prompt:
+                image_tasks.append(asyncio.create_task(copy_page_image(
+                    notify, book_dir, page_num, image_tasks_by_prompt[image_prompt]
+                )))
             else:
-                print(f"--- Using Standard Image Generation for Page {page_num} ---")
-                image_data, error2 = generate_image_from_prompt(
-                    prompt_text=image_prompt,
-                    size="1536x1024",
-                    quality="high"
-                )
-                if error2:
-                     print(f"Error during standard image generation for page {page_num}: {error2}")
-                     await websocket.send_text(json.dumps({"status": "warning", "message": f"Image generation failed for page {page_num}: {error2}. Skipping image."}))
-                     image_data = None
-
-
-            # Save Image (if successful)
-            if image_data:
-                output_filename = os.path.join(book_dir, f"page_{page_num:02d}.png")
-                try:
-                    with open(output_filename, "wb") as f:
-                        f.write(image_data)
-                    print(f"--- Stage 2 Success: Page {page_num} image saved successfully as {output_filename} ---")
-                    await websocket.send_text(json.dumps({"status": "progress", "message": f"Page {page_num}: Illustration saved."}))
+                # Pages are independent, so render them concurrently while Stage 1 moves on
+                image_tasks_by_prompt[image_prompt] = asyncio.create_task(render_page_image(
+                    notify, request, book_dir, page_num, image_prompt, None, page_semaphore
+                ))
+                image_tasks.append(image_tasks_by_prompt[image_prompt])
+
+        # Report illustrations as they finish rather than waiting for the slowest page
+        for finished, image_task in enumerate(asyncio.as_completed(image_tasks), start=1):
+            try:
+                await image_task
+            except Exception as e:
+                logger.error(f"Unexpected error while rendering a page illustration: {e}")
+            await notify({"status": "progress", "message": f"Illustrations finished: {finished}/{len(image_tasks)}"})
+        await cover_task
+        if batch_page_prompts:
+            await render_batched_page_images(notify, book_dir, batch_page_prompts)
+
+        logger.info("--- Book Generation Process Completed ---")
+        await notify({"status": "complete", "message": "Book generation finished!", "output_dir": book_dir})
+    finally:
+        # If notify raises (e.g. the WebSocket client disconnected), stop the illustrations still
+        # running so they don't keep making paid API calls, and collect every task's outcome
+        render_tasks = [cover_task, *image_tasks, *image_tasks_by_prompt.values()]
+        for task in render_tasks:
+            if not task.done():
+                task.cancel()
+        await asyncio.gather(*render_tasks, return_exceptions=True)
 
-                    if request.useExperimentalConsistency:
-                        previous_page_image_data = image_data
+@app.websocket("/ws/generate-progress")
+async def websocket_endpoint(websocket: WebSocket):
+    await websocket.accept()
+    logger.info("WebSocket connection accepted.")
+    try:
+        # Receive the book generation parameters from the frontend
+        data = await websocket.receive_text()
+        request = BookGenerationRequest.model_validate_json(data) # Use model_validate_json for Pydantic v2+
 
-                except IOError as e:
-                    print(f"Error saving image {output_filename}: {e}")
-                    await websocket.send_text(json.dumps({"status": "warning", "message": f"Error saving image for page {page_num}: {e}. Continuing."}))
+        logger.info("Received book generation request via WebSocket:")
+        logger.info(f"  Book Title: {request.bookTitle}")
+        logger.info(f"  Selected Style: {request.selectedStyle}")
+        logger.info(f"  Number of Pages: {request.numberOfPages}")
+        logger.info(f"  Quick Mode: {request.quickMode}")
+        if not request.quickMode:
+            logger.info(f"  Character Descriptions: {request.characterDescriptions}")
+        logger.info(f"  Story Outline: {request.storyOutline}")
+        logger.info(f"  Use Experimental Consistency: {request.useExperimentalConsistency}")
 
-            # Optional delay
-            # time.sleep(1)
+        # Stream every status message back to the frontend as it happens (as text frames,
+        # which is what the frontend's JSON.parse expects)
+        send_text = websocket.send_text # Bound once; called for every status message
+        async def send_status(payload):
+            await send_text(orjson.dumps(payload).decode())
 
-        print("\n--- Book Generation Process Completed ---")
-        await websocket.send_text(json.dumps({"status": "complete", "message": "Book generation finished!", "output_dir": book_dir}))
+        await generate_book(request, send_status)
 
     except WebSocketDisconnect:
-        print("Frontend disconnected during generation.")
+        logger.info("Frontend disconnected during generation.")
         # Clean up or log as needed
-    except json.JSONDecodeError:
-        print("Received invalid JSON data over WebSocket.")
+    except ValidationError as e:
+        logger.warning(f"Received invalid request data over WebSocket: {e}")
         try:
-            await websocket.send_text(json.dumps({"status": "error", "message": "Invalid JSON data received."}))
+            await websocket.send_text(orjson.dumps({"status": "error", "message": f"Invalid request data received: {e}"}).decode())
         except Exception:
             pass # Ignore if sending error message fails
     except Exception as e:
-        print(f"An unexpected error occurred during WebSocket generation: {e}")
+        logger.error(f"An unexpected error occurred during WebSocket generation: {e}")
         try:
-            await websocket.send_text(json.dumps({"status": "error", "message": f"An unexpected error occurred: {e}"}))
+            await websocket.send_text(orjson.dumps({"status": "error", "message": f"An unexpected error occurred: {e}"}).decode())
         except Exception:
             pass # Ignore if closing error message fails
     finally:
@@ -378,5 +652,76 @@ async def websocket_endpoint(websocket: WebSocket):
             pass # Ignore if closing fails
 
 
+# In-memory registry of background generation jobs, keyed by job id (oldest first). Each
+# job keeps every status message it emitted so clients can poll for progress. Finished jobs
+# are dropped after JOB_TTL seconds, and at most MAX_JOBS are kept: the oldest finished jobs
+# make room for new ones, and new jobs are refused while MAX_JOBS are still running.
+JOBS = OrderedDict()
+MAX_JOBS = 200
+JOB_TTL = 3600 # Seconds a finished job can still be polled
+
+def prune_jobs():
+    """Evicts expired finished jobs, then the oldest finished ones while the registry is full."""
+    expired_before = time.time() - JOB_TTL
+    finished = [job_id for job_id, job in JOBS.items() if job.get("finished_at") is not None]
+    for job_id in finished:
+        if JOBS[job_id]["finished_at"] < expired_before or len(JOBS) >= MAX_JOBS:
+            del JOBS[job_id]
+
+async def run_generation_job(job, request: BookGenerationRequest):
+    """Runs generate_book for a queued job, recording its status messages on the job."""
+    async def record_status(payload):
+        job["events"].append(payload)
+        if payload["status"] in ("error", "complete"):
+            job["status"] = payload["status"]
+            job["output_dir"] = payload.get("output_dir")
+            job["finished_at"] = time.time()
+
+    job["status"] = "running"
+    try:
+        await generate_book(request, record_status)
+    except Exception as e:
+        logger.error(f"An unexpected error occurred during job {job['job_id']}: {e}")
+        await record_status({"status": "error", "message": f"An unexpected error occurred: {e}"})
+
+@app.post("/api/generate-book", status_code=202)
+async def create_generation_job(request: BookGenerationRequest, background_tasks: BackgroundTasks):
+    """API endpoint that queues a book generation and returns its job id immediately."""
+    validation_error = validate_book_request(request)
+    if validation_error:
+        raise HTTPException(status_code=400, detail=validation_error)
+    prune_jobs()
+    if len(JOBS) >= MAX_JOBS:
+        raise HTTPException(status_code=503, detail="Too many book generations are in progress. Please try again later.")
+    job_id = uuid.uuid4().hex
+    job = {"job_id": job_id, "status": "queued", "events": [], "output_dir": None, "finished_at": None}
+    JOBS[job_id] = job
+    background_tasks.add_task(run_generation_job, job, request)
+    logger.info(f"Queued book generation job {job_id} for '{request.bookTitle}'.")
+    return {"job_id": job_id}
+
+@app.get("/api/jobs/{job_id}")
+async def get_generation_job(job_id: str):
+    """API endpoint to poll the status and progress messages of a generation job."""
+    prune_jobs()
+    job = JOBS.get(job_id)
+    if job is None:
+        raise HTTPException(status_code=404, detail=f"Job '{job_id}' not found.")
+    return job
+
+
 if __name__ == "__main__":
-    uvicorn.run(app, host="0.0.0.0", port=8000)
+    # loop/http "auto" pick uvloop and httptools when installed (uvicorn[standard]),
+    # and fall back to asyncio/h11 where they are unavailable (e.g. Windows).
+    # Jobs live in process memory, so only raise UVICORN_WORKERS if clients don't
+    # poll /api/jobs (or run behind sticky sessions).
+    uvicorn.run(
+        "api:app",
+        host="0.0.0.0",
+        port=8000,
+        loop="auto",
+        http="auto",
+        workers=int(os.getenv("UVICORN_WORKERS", "1")),
+        limit_concurrency=int(os.getenv("UVICORN_LIMIT_CONCURRENCY", "1000")),
+        timeout_keep_alive=30,
+    )
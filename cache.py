@@ -0,0 +1,173 @@
+import os
+import time
+import orjson
+import hashlib
+from dotenv import load_dotenv
+from utils import save_binary_file
+
+# --- Load Environment Variables ---
+load_dotenv()
+
+# --- Constants ---
+# Caching is opt-in: set SKRYB_CACHE=1 in .env to reuse results of identical requests
+CACHE_ENABLED = os.getenv("SKRYB_CACHE") == "1"
+CACHE_DIR = os.getenv("SKRYB_CACHE_DIR", "cache")
+IMAGE_CACHE_DIR = os.path.join(CACHE_DIR, "images")
+STRUCTURE_CACHE_DIR = os.path.join(CACHE_DIR, "structures")
+MAX_IMAGE_CACHE_ENTRIES = 500 # Least recently used images beyond this are deleted
+MAX_STRUCTURE_CACHE_ENTRIES = 5000 # Page structures are small, so many more are kept
+CACHE_TTL = None # Seconds an entry stays valid after it was written (None = no expiry)
+# Pruning walks the whole cache directory, so it runs once per this many writes rather than
+# after each one; a directory can briefly hold up to this many entries over its limit
+PRUNE_EVERY_WRITES = 25
+
+# Writes per cache directory since it was last pruned
+_writes_since_prune = {}
+
+# Lookups served from disk versus sent on to the API during this process
+CACHE_STATS = {"hits": 0, "misses": 0}
+
+def configure_cache(enabled=None, ttl=None):
+    """Overrides the .env cache settings (e.g. from command-line flags). None leaves a setting unchanged."""
+    global CACHE_ENABLED, CACHE_TTL
+    if enabled is not None:
+        CACHE_ENABLED = enabled
+    if ttl is not None:
+        CACHE_TTL = ttl
+
+# --- Shared Helpers ---
+def _cache_path(directory, key, extension):
+    """Returns the cache file for key, sharded by the first two hex digits."""
+    return os.path.join(directory, key[:2], f"{key}{extension}")
+
+def _read_cache_file(path):
+    """Returns the bytes stored at path, or None on a miss or when caching is disabled."""
+    if not CACHE_ENABLED:
+        return None
+
+    try:
+        written_at = os.stat(path).st_mtime
+        if CACHE_TTL is not None and time.time() - written_at > CACHE_TTL:
+            CACHE_STATS["misses"] += 1
+            return None # Expired; the next write replaces it
+        with open(path, "rb") as f:
+            data = f.read()
+    except FileNotFoundError:
+        CACHE_STATS["misses"] += 1
+        return None
+    except OSError as e:
+        print(f"Warning: Could not read cache entry {path}: {e}")
+        CACHE_STATS["misses"] += 1
+        return None
+
+    try:
+        os.utime(path, (time.time(), written_at)) # Record the access for pruning, keep the write time for the TTL
+    except OSError:
+        pass
+    CACHE_STATS["hits"] += 1
+    return data
+
+def _write_cache_file(path, data, max_entries):
+    """Writes data to path atomically, pruning its cache directory to max_entries every PRUNE_EVERY_WRITES writes."""
+    if not CACHE_ENABLED or not data:
+        return
+
+    try:
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        save_binary_file(path, data) # Readers never see a partially written file, and a failed write leaves no temp file
+    except OSError as e:
+        print(f"Warning: Could not write cache entry {path}: {e}")
+        return
+
+    directory = os.path.dirname(os.path.dirname(path))
+    _writes_since_prune[directory] = _writes_since_prune.get(directory, 0) + 1
+    if _writes_since_prune[directory] >= PRUNE_EVERY_WRITES:
+        _writes_since_prune[directory] = 0
+        _prune_cache_dir(directory, os.path.splitext(path)[1], max_entries)
+
+def _prune_cache_dir(directory, extension, max_entries):
+    """Deletes the least recently used entries in directory so at most max_entries remain."""
+    entries = []
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if name.endswith(extension):
+                path = os.path.join(root, name)
+                try:
+                    entries.append((os.path.getatime(path), path))
+                except OSError:
+                    pass # Removed by another process in the meantime
+
+    if len(entries) <= max_entries:
+        return
+
+    entries.sort()
+    for _, path in entries[:len(entries) - max_entries]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+# --- Image Cache ---
+def image_cache_key(prompt_text, size, quality, model="gpt-image-1"):
+    """Returns the content hash identifying an image generation request."""
+    return hashlib.sha256(f"{prompt_text}|{size}|{quality}|{model}".encode("utf-8")).hexdigest()
+
+def edit_cache_key(previous_image, prompt_text, size, quality, model="gpt-image-1"):
+    """
+    Returns the content hash identifying an image edit request, which also covers the
+    image being edited (bytes, or the path of a saved image).
+
+    Returns None when caching is disabled or the image can't be read, so the input
+    image is only hashed when the result could be reused.
+    """
+    if not CACHE_ENABLED:
+        return None
+
+    digest = hashlib.sha256()
+    if isinstance(previous_image, (str, os.PathLike)):
+        try:
+            with open(previous_image, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    digest.update(chunk)
+        except OSError:
+            return None
+    else:
+        digest.update(previous_image)
+    return image_cache_key(f"{prompt_text}|edit:{digest.hexdigest()}", size, quality, model)
+
+def get_cached_image(key):
+    """
+    Looks up a previously generated image.
+
+    Returns:
+        bytes or None: The cached image data, or None on a miss or when caching is disabled.
+    """
+    return _read_cache_file(_cache_path(IMAGE_CACHE_DIR, key, ".png"))
+
+def store_cached_image(key, image_data):
+    """Writes a generated image to the cache (atomically) and prunes old entries."""
+    _write_cache_file(_cache_path(IMAGE_CACHE_DIR, key, ".png"), image_data, MAX_IMAGE_CACHE_ENTRIES)
+
+def prune_image_cache(max_entries=MAX_IMAGE_CACHE_ENTRIES):
+    """Deletes the least recently used cached images so at most max_entries remain."""
+    _prune_cache_dir(IMAGE_CACHE_DIR, ".png", max_entries)
+
+# --- Page Structure Cache ---
+def structure_cache_key(model, messages):
+    """Returns the content hash identifying a Stage 1 request (the model and the full message history)."""
+    payload = orjson.dumps([model, messages], option=orjson.OPT_SORT_KEYS)
+    return hashlib.sha256(payload).hexdigest()
+
+def get_cached_structure(key):
+    """
+    Looks up a previously generated page structure.
+
+    Returns:
+        str or None: The cached response content, or None on a miss or when caching is disabled.
+    """
+    data = _read_cache_file(_cache_path(STRUCTURE_CACHE_DIR, key, ".json"))
+    return data.decode("utf-8") if data is not None else None
+
+def store_cached_structure(key, content):
+    """Writes a Stage 1 response's content to the cache (atomically) and prunes old entries."""
+    _write_cache_file(_cache_path(STRUCTURE_CACHE_DIR, key, ".json"), content.encode("utf-8"), MAX_STRUCTURE_CACHE_ENTRIES)
@@ -1,20 +1,439 @@
 import os
 import re
-import json
+import orjson
 import time
+import hashlib
 import sys # For exiting
+import asyncio
+import shutil
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from openai_api import (
     generate_single_page_structure, # Use the history-based function
+    generate_all_pages_structure, # Writes every page in one request (--single-request)
+    compact_message_history, # Summarises older pages in long books
+    HISTORY_WINDOW_PAGES,
+    replay_single_page_structure, # Rebuilds history from saved pages when resuming
     generate_image_from_prompt,
     infer_characters, # Import the new function
     check_api_key,
     PROMPTS, # Import the loaded prompts
-    edit_image_from_prompt # Import the edit function
+    edit_image_from_prompt, # Import the edit function
+    asubmit_image_batch,
+    await_image_batch
 )
-from utils import sanitize_filename, get_user_input
+from utils import sanitize_filename, get_user_input, build_character_matcher, compile_prompt_template, save_binary_file
+import cache
+
+# Maximum number of page images requested from OpenAI at the same time in standard mode
+MAX_CONCURRENT_IMAGES = 8
+# Image options accepted by gpt-image-1; lower quality or a square size make quicker, cheaper drafts
+IMAGE_SIZES = ("1536x1024", "1024x1024", "1024x1536")
+IMAGE_QUALITIES = ("high", "medium", "low")
+DEFAULT_IMAGE_SIZE = "1536x1024" # Wide format for the cover and pages
+DEFAULT_IMAGE_QUALITY = "high"
+# Files written per page: the image and the raw Stage 1 response (used to resume a book)
+PAGE_FILE_PATTERN = re.compile(r"page_(\d+)\.(png|json)$")
+# Records which inputs a book directory was generated from, so a rerun only resumes the same book
+BOOK_MANIFEST_FILE = "book.json"
+
+def find_existing_pages(book_dir):
+    """
+    Scans the book directory for pages left by an earlier run.
+
+    Returns:
+        set: Page numbers that already have an image.
+        set: Page numbers that have a saved Stage 1 response.
+    """
+    page_images, page_structures = set(), set()
+    with os.scandir(book_dir) as entries:
+        for entry in entries:
+            match = PAGE_FILE_PATTERN.match(entry.name)
+            if match:
+                (page_images if match.group(2) == "png" else page_structures).add(int(match.group(1)))
+    return page_images, page_structures
+
+def book_inputs_hash(characters, story_outline, style_key, page_template, total_pages, use_experimental_consistency, size, quality):
+    """Returns a hash of everything that shapes a book's pages, stored in its manifest to check resumes against."""
+    payload = orjson.dumps(
+        [characters, story_outline, style_key, page_template, total_pages, use_experimental_consistency, size, quality],
+        option=orjson.OPT_SORT_KEYS
+    )
+    return hashlib.sha256(payload).hexdigest()
+
+def read_book_manifest(book_dir):
+    """Returns the inputs hash saved in the book directory's manifest, or None if there is none (or it is unreadable)."""
+    try:
+        with open(os.path.join(book_dir, BOOK_MANIFEST_FILE), "rb") as f:
+            return orjson.loads(f.read()).get("inputs_hash")
+    except (OSError, orjson.JSONDecodeError, AttributeError):
+        return None
+
+def write_book_manifest(book_dir, inputs_hash):
+    """Saves the manifest recording which inputs the book directory is generated from."""
+    save_binary_file(os.path.join(book_dir, BOOK_MANIFEST_FILE), orjson.dumps({"inputs_hash": inputs_hash}))
+
+def page_structure_path(book_dir, page_num):
+    """Returns the path of the saved Stage 1 response for a page."""
+    return os.path.join(book_dir, f"page_{page_num:02d}.json")
+
+def page_image_path(book_dir, page_num):
+    """Returns the path of a page's illustration."""
+    return os.path.join(book_dir, f"page_{page_num:02d}.png")
+
+def generate_and_save_page_image(book_dir, page_num, image_prompt, size=DEFAULT_IMAGE_SIZE, quality=DEFAULT_IMAGE_QUALITY):
+    """
+    Generates one page image and writes it to disk as soon as it arrives, so the
+    PNG bytes are not kept in memory until every page has finished.
+
+    Returns:
+        tuple: (saved, error, input_image_for_edit) - whether the image was saved, the
+        generation error if any, and the image an edit started from (always None here).
+    """
+    image_data, error = generate_image_from_prompt(
+        prompt_text=image_prompt,
+        size=size,
+        quality=quality
+    )
+    if error:
+        return False, error, None
+    return save_page_image(book_dir, page_num, image_data), None, None
+
+def edit_and_save_page_image(book_dir, page_num, image_prompt, chain, size=DEFAULT_IMAGE_SIZE, quality=DEFAULT_IMAGE_QUALITY):
+    """
+    Consistency mode: edits the last saved illustration (chain["image_path"], starting
+    with the cover) into this page's image and saves it.
+
+    Runs on a single worker thread, so pages render strictly in order while Stage 1
+    moves on to the next page. A failed page leaves the chain on the last good image.
+
+    Returns the same (saved, error, input_image_for_edit) triple as generate_and_save_page_image.
+    """
+    input_image_for_edit = chain["image_path"]
+    if input_image_for_edit:
+        print(f"--- Using Image Editing (from {os.path.basename(input_image_for_edit)}) for Page {page_num} ---")
+        image_data, error = edit_image_from_prompt(
+            input_image_for_edit, # Read from disk, so finished pages aren't kept in memory
+            prompt_text=image_prompt,
+            size=size,
+            quality=quality
+        )
+    else:
+        print(f"Warning: Experimental Consistency mode is on, but there is no previous image for page {page_num}. Falling back to standard generation.")
+        image_data, error = generate_image_from_prompt(
+            prompt_text=image_prompt,
+            size=size,
+            quality=quality
+        )
+    if error:
+        return False, error, input_image_for_edit
+    saved = save_page_image(book_dir, page_num, image_data)
+    if saved:
+        chain["image_path"] = page_image_path(book_dir, page_num)
+    return saved, None, input_image_for_edit
+
+def collect_page_images(page_image_futures):
+    """
+    Waits for the page images submitted to the thread pool.
+
+    Args:
+        page_image_futures (dict): Maps page numbers to futures of generate_and_save_page_image
+            or edit_and_save_page_image.
+
+    Returns:
+        dict: Maps each page number to a (saved, error, input_image_for_edit) triple.
+    """
+    page_results = {}
+    for page_num, future in page_image_futures.items():
+        try:
+            page_results[page_num] = future.result()
+        except Exception as e:
+            page_results[page_num] = (False, f"An unexpected error occurred during image generation: {e}", None)
+    return page_results
+
+async def generate_page_images_batch(page_prompts, size=DEFAULT_IMAGE_SIZE, quality=DEFAULT_IMAGE_QUALITY, cover_prompt=None):
+    """
+    Generates the images for several independent pages (and optionally the cover)
+    through one OpenAI Batch API job.
+
+    Takes a dict mapping page numbers to image prompts. Batches are billed at a discount
+    but may take up to 24 hours to complete.
+
+    Returns:
+        dict: Maps each page number to an (image_data, error) pair.
+        tuple or None: The cover's (image_data, error) pair, or None without a cover_prompt.
+    """
+    prompts_by_id = {f"page_{page_num:02d}": image_prompt for page_num, image_prompt in page_prompts.items()}
+    if cover_prompt:
+        prompts_by_id["cover"] = cover_prompt
+    batch_id, batch_error = await asubmit_image_batch(prompts_by_id, size=size, quality=quality)
+    if not batch_error:
+        print(f"Batch {batch_id} submitted. Waiting for it to complete (this can take a while)...")
+        results, batch_error = await await_image_batch(batch_id)
+    if batch_error:
+        return {page_num: (None, batch_error) for page_num in page_prompts}, (None, batch_error) if cover_prompt else None
+
+    page_results = {
+        page_num: results.get(f"page_{page_num:02d}", (None, "No result returned for this page."))
+        for page_num in page_prompts
+    }
+    cover_result = results.get("cover", (None, "No result returned for the cover.")) if cover_prompt else None
+    return page_results, cover_result
+
+def resolve_page_edit(book_dir, page_num, image_prompt, page_image_future, chain, size=DEFAULT_IMAGE_SIZE, quality=DEFAULT_IMAGE_QUALITY, on_retry=None):
+    """
+    Consistency mode: waits for a page's edit and, if it failed, runs the interactive retry
+    right away, so the next page edits this page rather than the one before it.
+
+    Only called while the single worker is idle, so chain can be updated directly.
+
+    Returns:
+        tuple: (saved, error, input_image_for_edit), with error always None since the retry has run.
+    """
+    saved, error2, input_image_for_edit = collect_page_images({page_num: page_image_future})[page_num]
+    if error2:
+        image_data = retry_page_image(
+            page_num, image_prompt, error2, input_image_for_edit,
+            size=size, quality=quality, on_retry=on_retry
+        )
+        saved = bool(image_data) and save_page_image(book_dir, page_num, image_data)
+        if saved:
+            chain["image_path"] = page_image_path(book_dir, page_num)
+    return saved, None, input_image_for_edit
+
+def prompt_for_revision(prompt_text, error):
+    """
+    Default on_retry handler: asks the user for a revised prompt after an image failed.
+
+    Returns:
+        str or None: The revised prompt, or None to skip the image.
+    """
+    try:
+        user_response = get_user_input("Enter revised prompt (or type 'SKIP' to skip this image): ").strip() # Use get_user_input
+    except EOFError:
+        print("\nNo input received, skipping this image.")
+        return None # Treat EOF as skip
+    return None if user_response.upper() == 'SKIP' else user_response
+
+def skip_failed_image(prompt_text, error):
+    """Non-interactive on_retry handler (--skip-failed): always skips the image."""
+    return None
+
+def retry_page_image(page_num, image_prompt, error2, input_image_for_edit=None, size=DEFAULT_IMAGE_SIZE, quality=DEFAULT_IMAGE_QUALITY, on_retry=prompt_for_revision):
+    """
+    Retry loop for a page image that failed to generate or edit.
+
+    on_retry(prompt_text, error) is asked for a revised prompt after each failure and
+    returns None to give up on the page.
+
+    Returns:
+        bytes or None: The image data from a successful retry, or None if the page was skipped.
+    """
+    image_data = None
+    while error2:
+        print(f"\n--- Image Generation/Editing Failed for Page {page_num} ---")
+        print(f"Error: {error2}")
+        print("\n--- Failed Prompt ---")
+        print(image_prompt)
+        print("--------------------")
+
+        revised_prompt = on_retry(image_prompt, error2)
+        if revised_prompt is None:
+            print(f"Skipping image generation/editing for page {page_num}.")
+            return None
+        print("Retrying image generation/editing with revised prompt...")
+        image_prompt = revised_prompt # Update the prompt
+        # Retry using the same method (generate or edit) that failed
+        if input_image_for_edit: # Check if we were attempting edit
+             image_data, error2 = edit_image_from_prompt(
+                 input_image_for_edit, # Use the same input image as before
+                 prompt_text=image_prompt,
+                 size=size,
+                 quality=quality
+             )
+        else: # Otherwise, retry standard generation
+             image_data, error2 = generate_image_from_prompt(
+                 prompt_text=image_prompt,
+                 size=size,
+                 quality=quality
+             )
+        # Loop continues if error2 is still present after retry
+    return image_data
+
+def save_cover_image(book_dir, image_data):
+    """
+    Saves the cover as cover.png in the book directory.
+
+    Returns:
+        str or None: The path of the saved cover, or None if it could not be written.
+    """
+    cover_filename = os.path.join(book_dir, "cover.png")
+    try:
+        save_binary_file(cover_filename, image_data)
+        print(f"Cover image saved successfully as {cover_filename}")
+        return cover_filename
+    except IOError as e:
+        print(f"Error saving cover image {cover_filename}: {e}")
+        return None
+
+def generate_and_save_cover(book_dir, cover_prompt, chain, size=DEFAULT_IMAGE_SIZE, quality=DEFAULT_IMAGE_QUALITY):
+    """
+    Generates the cover image and saves it, then points chain["image_path"] at it so
+    consistency mode edits the cover into page 1.
+
+    Returns:
+        tuple: (saved, error) - whether the cover was saved, and the generation error if any.
+    """
+    image_data, error = generate_image_from_prompt(
+        prompt_text=cover_prompt,
+        size=size,
+        quality=quality
+    )
+    if error:
+        return False, error
+    cover_path = save_cover_image(book_dir, image_data)
+    if cover_path:
+        chain["image_path"] = cover_path
+    return bool(cover_path), None
+
+def retry_cover_image(book_dir, cover_prompt, cover_error, size=DEFAULT_IMAGE_SIZE, quality=DEFAULT_IMAGE_QUALITY, on_retry=prompt_for_revision):
+    """
+    Retry loop for a cover image that failed to generate, asking on_retry for a revised
+    prompt after each failure. Saves the cover if a retry succeeds.
+
+    Returns:
+        str or None: The path of the saved cover, or None if it was skipped or could not be saved.
+    """
+    while cover_error:
+        print(f"\n--- Cover Image Generation Failed ---")
+        print(f"Error: {cover_error}")
+        print("\n--- Failed Prompt ---")
+        print(cover_prompt)
+        print("--------------------------")
+
+        revised_prompt = on_retry(cover_prompt, cover_error)
+        if revised_prompt is None:
+            print("Skipping cover image generation.")
+            return None
+        print("Retrying cover image generation with revised prompt...")
+        cover_prompt = revised_prompt # Update the prompt
+        cover_image_data, cover_error = generate_image_from_prompt(
+            prompt_text=cover_prompt,
+            size=size,
+            quality=quality
+        )
+        # Loop continues if cover_error is still present after retry
+    return save_cover_image(book_dir, cover_image_data)
+
+def collect_cover_image(cover_future):
+    """Waits for the cover submitted to the thread pool. Returns the generation error, if any."""
+    try:
+        _, cover_error = cover_future.result()
+    except Exception as e:
+        cover_error = f"An unexpected error occurred during cover generation: {e}"
+    return cover_error
 
-def main():
-    """Main function to run the two-stage book creation CLI."""
+def save_page_image(book_dir, page_num, image_data):
+    """Saves a page image as page_NN.png in the book directory. Returns True on success."""
+    output_filename = page_image_path(book_dir, page_num)
+    try:
+        save_binary_file(output_filename, image_data)
+        print(f"--- Stage 2 Success: Page {page_num} image saved successfully as {output_filename} ---")
+        return True
+    except IOError as e:
+        print(f"Error saving image {output_filename}: {e}")
+        return False
+
+def copy_page_image(book_dir, source_page_num, page_num):
+    """Reuses another page's saved image for a page with the identical prompt. Returns True on success."""
+    output_filename = page_image_path(book_dir, page_num)
+    try:
+        shutil.copyfile(page_image_path(book_dir, source_page_num), output_filename)
+        print(f"--- Stage 2 Success: Page {page_num} reuses the image of page {source_page_num} ({output_filename}) ---")
+        return True
+    except OSError as e:
+        print(f"Error copying image for page {page_num}: {e}")
+        return False
+
+def parse_args():
+    """Parses the command-line flags for non-interactive options."""
+    parser = argparse.ArgumentParser(description="SKRYB - The AI Book Generator (CLI)")
+    parser.add_argument(
+        "--batch",
+        action="store_true",
+        help="Submit the cover and all page images as one OpenAI Batch API job (cheaper, but can take up to 24 hours). "
+             "Ignored in Experimental Consistency Mode."
+    )
+    parser.add_argument(
+        "--quality",
+        choices=IMAGE_QUALITIES,
+        default=DEFAULT_IMAGE_QUALITY,
+        help="Image quality for the cover and pages. 'medium' or 'low' are faster and cheaper for drafts."
+    )
+    parser.add_argument(
+        "--size",
+        choices=IMAGE_SIZES,
+        default=DEFAULT_IMAGE_SIZE,
+        help="Image size for the cover and pages, e.g. 1024x1024 to preview before a wide-format run."
+    )
+    parser.add_argument(
+        "--history-window",
+        type=int,
+        default=HISTORY_WINDOW_PAGES,
+        metavar="PAGES",
+        help="Once the story is longer than twice this many pages, earlier pages are sent to Stage 1 "
+             "as a short summary instead of in full. 0 always sends the full history."
+    )
+    parser.add_argument(
+        "--single-request",
+        action="store_true",
+        help="Write the text of every page in one Stage 1 request instead of one request per page. "
+             "Falls back to page-by-page generation for long books or if the request fails."
+    )
+    parser.add_argument(
+        "--skip-failed",
+        action="store_true",
+        help="Skip images that still fail after the automatic retries instead of asking for a revised prompt."
+    )
+    parser.add_argument(
+        "--force",
+        action="store_true",
+        help="Regenerate the cover and every page, even if the book directory already has them from an earlier run. "
+             "Required when the directory holds a book generated from different inputs."
+    )
+    cache_group = parser.add_mutually_exclusive_group()
+    cache_group.add_argument(
+        "--cache",
+        dest="cache",
+        action="store_true",
+        default=None,
+        help="Reuse page structures and images from earlier runs with identical prompts (overrides SKRYB_CACHE)."
+    )
+    cache_group.add_argument(
+        "--no-cache",
+        dest="cache",
+        action="store_false",
+        help="Always call the API, ignoring and not writing the cache (overrides SKRYB_CACHE)."
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=None,
+        metavar="SECONDS",
+        help="Treat cache entries older than this many seconds as misses."
+    )
+    return parser.parse_args()
+
+def main(args, on_retry=None):
+    """
+    Main function to run the two-stage book creation CLI.
+
+    on_retry(prompt_text, error) supplies a revised prompt when an image fails, or None
+    to skip it. Defaults to asking the user (or skipping, with --skip-failed).
+    """
+    if on_retry is None:
+        on_retry = skip_failed_image if args.skip_failed else prompt_for_revision
+    cache.configure_cache(enabled=args.cache, ttl=args.cache_ttl)
     print("Welcome to SKRYB - The AI Book Generator!")
     start_time = time.time()
 
@@ -51,6 +470,11 @@ def main():
     if not PROMPTS:
         print("Error: Could not load prompts from prompts.json. Exiting.")
         return
+    try:
+        cover_template = PROMPTS['cover_image_generation']['prompt_template']
+    except KeyError as e:
+        print(f"Error accessing cover prompt template key in prompts.json: {e}. Exiting.")
+        return
 
     # --- Get Common User Choices ---
     book_title = get_user_input("\nEnter a title for your book:")
@@ -93,8 +517,26 @@ def main():
             break
         else:
             print("Invalid choice. Please enter 'yes' or 'no'.")
+    if args.batch and use_experimental_consistency:
+        print("Note: --batch is ignored in Experimental Consistency Mode, since each page edits the previous image.")
 
 
+    # --- Resolve the page prompt template once, before any API calls (including character inference) are made ---
+    style_type = chosen_style.get('type', 'childrens') # Default to 'childrens' if type is missing
+    text_key_for_image = "script_text" if style_type == "narrative" else "page_text"
+    if use_experimental_consistency:
+        # Use the edit prompt template if consistency is on
+        prompt_template_key = f"{chosen_style['key']}_edit"
+    else:
+        # Use the standard generation prompt template
+        prompt_template_key = chosen_style['key']
+    try:
+        fill_image_prompt = compile_prompt_template(PROMPTS[prompt_template_key]['prompt_template'])
+    except KeyError:
+        print(f"Error: Could not find '{prompt_template_key}' or 'prompt_template' in prompts.json.")
+        return
+    print(f"Using page prompt template: {prompt_template_key}")
+
     # --- Get Mode-Specific Inputs ---
     if quick_mode:
         story_outline = get_user_input(
@@ -146,74 +588,111 @@ def main():
         print(f"Error creating directory {book_dir}: {e}")
         return
 
-    # --- Generate Cover Image ---
-    print("\n--- Running Cover Generation ---")
-    cover_image_data = None # Initialize cover_image_data before the try block
+    # Resume an interrupted run: saved responses rebuild the history, existing images are kept.
+    # Only a directory generated from the same inputs is resumed, so a new story never picks
+    # up the cover or pages of an earlier one that had the same title.
+    inputs_hash = book_inputs_hash(
+        characters, story_outline, chosen_style['key'], PROMPTS[prompt_template_key]['prompt_template'],
+        total_pages, use_experimental_consistency, args.size, args.quality
+    )
+    existing_images, saved_structures = set(), set()
+    has_cover = False
+    if not args.force:
+        try:
+            existing_images, saved_structures = find_existing_pages(book_dir)
+            has_cover = os.path.exists(os.path.join(book_dir, "cover.png"))
+        except OSError as e:
+            print(f"Warning: Could not scan {book_dir} for existing pages: {e}")
+        if existing_images or saved_structures or has_cover:
+            if read_book_manifest(book_dir) != inputs_hash:
+                print(f"Error: {book_dir} already contains a book generated from different inputs "
+                      "(characters, outline, style, page count, consistency mode, size or quality).")
+                print("Use --force to regenerate it from scratch, or choose a different title.")
+                return
+            print(f"Resuming: found {len(saved_structures)} saved page texts and {len(existing_images)} page images (use --force to regenerate them).")
     try:
-        cover_template = PROMPTS['cover_image_generation']['prompt_template']
-        all_char_details_string = "\n".join([f"- {name}: {desc}" for name, desc in characters.items()])
-        # Pass style description to cover prompt
-        cover_prompt = cover_template.format(
-            character_details_string=all_char_details_string,
-            book_title=book_title,
-            style_description=chosen_style['desc'] # Pass style description
-        )
-        print("Generating cover image...")
-        cover_image_data, cover_error = generate_image_from_prompt(
-            prompt_text=cover_prompt,
-            size="1536x1024", # Changed to wide aspect ratio
-            quality="high"
-        )
-
-        # --- Interactive Retry Loop for Cover Image Errors ---
-        while cover_error:
-            print(f"\n--- Cover Image Generation Failed ---")
-            print(f"Error: {cover_error}")
-            print("\n--- Failed Prompt ---")
-            print(cover_prompt)
-            print("--------------------------")
+        write_book_manifest(book_dir, inputs_hash)
+    except OSError as e:
+        print(f"Warning: Could not save the book manifest in {book_dir}: {e}")
+
+    # Each image starts as soon as its prompt is ready, so the cover and page images render
+    # while Stage 1 continues with the next page. Consistency mode uses a single worker so
+    # each edit starts from the image before it. Batch mode submits the cover and all page
+    # prompts as one job after the loop.
+    batch_images = args.batch and not use_experimental_consistency
+    image_executor = None
+    if use_experimental_consistency:
+        image_executor = ThreadPoolExecutor(max_workers=1)
+    elif not batch_images:
+        image_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_IMAGES)
+    consistency_chain = {"image_path": None} # The illustration the next consistency-mode page edits
+
+    # Each character's prompt line is formatted once and reused for the cover and every page
+    char_detail_lines = {name: f"- {name}: {desc}" for name, desc in characters.items()}
 
-            try:
-                user_response = get_user_input("Enter revised prompt for cover (or type 'SKIP' to skip cover image): ").strip() # Use get_user_input
-            except EOFError:
-                print("\nNo input received, skipping cover image.")
-                user_response = "SKIP" # Treat EOF as skip
-
-            if user_response.upper() == 'SKIP':
-                print("Skipping cover image generation.")
-                cover_image_data = None # Ensure no cover image is saved
-                cover_error = None # Break the loop
+    # --- Generate Cover Image ---
+    print("\n--- Running Cover Generation ---")
+    cover_prompt = None
+    cover_future = None
+    existing_cover = os.path.join(book_dir, "cover.png")
+    if has_cover:
+        # Resuming a book: keep the cover from the earlier run (consistency mode edits it into page 1)
+        print(f"--- Skipping cover, it already exists ({existing_cover}). ---")
+        consistency_chain["image_path"] = existing_cover
+    else:
+        try:
+            all_char_details_string = "\n".join(char_detail_lines.values())
+            # Pass style description to cover prompt
+            cover_prompt = cover_template.format(
+                character_details_string=all_char_details_string,
+                book_title=book_title,
+                style_description=chosen_style['desc'] # Pass style description
+            )
+            if batch_images:
+                print("The cover will be generated with the page batch.")
             else:
-                print("Retrying cover image generation with revised prompt...")
-                cover_prompt = user_response # Update the prompt
-                cover_image_data, cover_error = generate_image_from_prompt(
-                    prompt_text=cover_prompt,
-                    size="1536x1024",
-                    quality="high"
+                # The cover only needs the characters and title, so it renders while Stage 1 writes page 1.
+                # In consistency mode it is first on the single worker, so page 1's edit starts from it.
+                print("Generating cover image in the background...")
+                cover_future = image_executor.submit(
+                    generate_and_save_cover, book_dir, cover_prompt, consistency_chain, args.size, args.quality
                 )
-                # Loop continues if cover_error is still present after retry
-
-        # --- Save Cover Image (if successful or not skipped) ---
-        if cover_image_data:
-            cover_filename = os.path.join(book_dir, "cover.png")
-            try:
-                with open(cover_filename, "wb") as f:
-                    f.write(cover_image_data)
-                print(f"Cover image saved successfully as {cover_filename}")
-            except IOError as e:
-                print(f"Error saving cover image {cover_filename}: {e}")
-
-    except KeyError as e:
-        print(f"Error accessing cover prompt template key in prompts.json: {e}")
-    except Exception as e:
-        print(f"An unexpected error occurred during cover generation: {e}")
+        except KeyError as e:
+            print(f"Error: Could not find key {e} when formatting the cover prompt. Check prompts.json.")
+        except Exception as e:
+            print(f"An unexpected error occurred during cover generation: {e}")
 
 
     # --- Loop through pages, maintaining history and potentially previous image ---
     print("\n--- Starting Page Generation ---")
+    # Optionally write the whole story up front; the pages are then saved like any other
+    # Stage 1 responses, so the loop below replays them to build the usual history
+    if args.single_request and not saved_structures:
+        print("--- Running Stage 1: Generating Structure for All Pages... ---")
+        all_pages, all_pages_error = generate_all_pages_structure(
+            characters, story_outline, total_pages, style_type=style_type
+        )
+        if all_pages_error:
+            print(f"Falling back to page-by-page generation: {all_pages_error}")
+        else:
+            for page_num, page_data in enumerate(all_pages, start=1):
+                structure_path = page_structure_path(book_dir, page_num)
+                try:
+                    save_binary_file(structure_path, orjson.dumps(page_data))
+                    saved_structures.add(page_num)
+                except OSError as e:
+                    print(f"Warning: Could not save {structure_path}: {e}")
     all_pages_successful = True
     message_history = [] # Initialize empty history
-    previous_page_image_data = None # Initialize variable to store previous image data
+    page_prompts = {} # Page number -> image prompt
+    page_image_futures = {}
+    # Consistency mode: pages whose edit was resolved (and retried if needed) before the next page was queued
+    resolved_page_results = {}
+    last_edit_page = None
+    # Identical prompts are rendered once; later pages with the same prompt copy that image
+    first_page_by_prompt = {}
+    # One compiled pattern finds every mentioned character in a single pass over the scene
+    find_mentioned_characters = build_character_matcher(characters)
 
     for page_num in range(1, total_pages + 1): # Use dynamic total_pages
         progress_percent = int((page_num / total_pages) * 100)
@@ -221,36 +700,49 @@ def main():
 
         # --- Stage 1: Generate Single Page Structure ---
         print(f"--- Running Stage 1: Generating Structure for Page {page_num}... ---")
+        structure_path = page_structure_path(book_dir, page_num)
+        saved_content = None
+        if page_num in saved_structures:
+            try:
+                with open(structure_path, "r", encoding="utf-8") as f:
+                    saved_content = f.read()
+            except OSError as e:
+                print(f"Warning: Could not read {structure_path}: {e}. Regenerating the page.")
+
         # Pass the chosen style type to determine which Stage 1 prompt to use
-        style_type = chosen_style.get('type', 'childrens') # Default to 'childrens' if type is missing
-        page_data, updated_history, error1 = generate_single_page_structure(
-            characters, story_outline, page_num, message_history, total_pages, style_type=style_type
-        )
-        message_history = updated_history # Update history for the next iteration
+        if saved_content is not None:
+            page_data, updated_history, error1 = replay_single_page_structure(
+                characters, story_outline, page_num, message_history, saved_content, total_pages, style_type=style_type
+            )
+            if error1:
+                print(f"Warning: Could not reuse {structure_path}: {error1}. Regenerating the page.")
+                saved_content = None
+        if saved_content is None:
+            page_data, updated_history, error1 = generate_single_page_structure(
+                characters, story_outline, page_num, message_history, total_pages, style_type=style_type
+            )
+            if not error1 and page_data:
+                try:
+                    save_binary_file(structure_path, updated_history[-1]["content"].encode("utf-8")) # The assistant's response
+                except OSError as e:
+                    print(f"Warning: Could not save {structure_path}: {e}")
+        # Update history for the next iteration, summarising older pages in long books
+        message_history = compact_message_history(updated_history, args.history_window)
 
         if error1:
             print(f"\nError generating structure for page {page_num}: {error1}")
             all_pages_successful = False
             # If structure generation fails, we cannot generate an image for this page.
-            # We also cannot provide a previous image for the *next* page if consistency mode is on.
-            # For now, we'll just continue, which means previous_page_image_data won't be updated,
-            # and the next page in consistency mode will likely fail or use an old image.
-            # A more robust approach might involve skipping image generation for the next page too,
-            # or attempting a standard generation if the previous image is missing.
+            # In consistency mode the next page then edits the last illustration that was saved.
             continue
         if not page_data:
             print(f"\nFailed to generate structure for page {page_num} (no error message).")
             all_pages_successful = False
             continue
 
-        # Extract the correct text based on style type
+        # Extract the correct text based on style type (script_text for narrative, page_text for childrens)
         scene_desc = page_data.get("scene_description", "")
-        if style_type == "narrative":
-            page_content_text = page_data.get("script_text", "") # Expect script_text for narrative
-            text_key_for_image = "script_text"
-        else: # childrens
-            page_content_text = page_data.get("page_text", "") # Expect page_text for childrens
-            text_key_for_image = "page_text"
+        page_content_text = page_data.get(text_key_for_image, "")
 
         if not page_content_text:
              print(f"Warning: No '{text_key_for_image}' found in Stage 1 output for page {page_num}.")
@@ -263,47 +755,17 @@ def main():
         print(f"--- Running Stage 2: Generating/Editing Image for Page {page_num}... ---")
 
         # Find characters mentioned in this scene's description
-        mentioned_chars = {
-            name: desc for name, desc in characters.items()
-            if name.lower() in scene_desc.lower()
-        }
-        char_details_string = "\n".join([f"- {name}: {desc}" for name, desc in mentioned_chars.items()])
+        mentioned_chars = find_mentioned_characters(scene_desc)
+        char_details_string = "\n".join([char_detail_lines[name] for name in mentioned_chars])
         if not char_details_string:
              char_details_string = "(No specific characters mentioned in scene description)"
 
-        # --- Stage 2: Generate or Edit Image ---
-        print(f"--- Running Stage 2: Generating/Editing Image for Page {page_num}... ---")
-
-        # Find characters mentioned in this scene's description
-        mentioned_chars = {
-            name: desc for name, desc in characters.items()
-            if name.lower() in scene_desc.lower()
-        }
-        char_details_string = "\n".join([f"- {name}: {desc}" for name, desc in mentioned_chars.items()])
-        if not char_details_string:
-             char_details_string = "(No specific characters mentioned in scene description)"
-
-        # --- Select and Format Image Prompt based on mode ---
+        # --- Format Image Prompt ---
         image_prompt = None
-        error2 = None
-        img_prompt_template = None
-        prompt_template_key = None # Store the key used for the prompt template
-
         try:
-            if use_experimental_consistency:
-                # Use the edit prompt template if consistency is on
-                prompt_template_key = f"{chosen_style['key']}_edit"
-                img_prompt_template = PROMPTS[prompt_template_key]['prompt_template']
-                print(f"--- Using Edit Prompt Template: {prompt_template_key} ---")
-            else:
-                # Use the standard generation prompt template
-                prompt_template_key = chosen_style['key']
-                img_prompt_template = PROMPTS[prompt_template_key]['prompt_template']
-                print(f"--- Using Generation Prompt Template: {prompt_template_key} ---")
-
             # Use the correct text variable (page_text or script_text) based on the key expected by the template
             # We'll pass both, but the template should only use one ({page_text} or {script_text})
-            image_prompt = img_prompt_template.format(
+            image_prompt = fill_image_prompt(
                 scene_description=scene_desc,
                 character_details_string=char_details_string,
                 page_text=page_content_text if text_key_for_image == "page_text" else "", # Pass relevant text or empty
@@ -315,7 +777,6 @@ def main():
                  print(f"Error: Image prompt template '{prompt_template_key}' expects '{{{text_key_for_image}}}' but it was missing in Stage 1 output for page {page_num}.")
             else:
                  print(f"Error: Could not find key '{str(e)}' when formatting image prompt for page {page_num}. Check prompts.json.")
-            print(f"Error: Could not find '{prompt_template_key}' or 'prompt_template' in prompts.json for page {page_num}")
             all_pages_successful = False
             continue
         except Exception as e:
@@ -323,107 +784,101 @@ def main():
              all_pages_successful = False
              continue
 
-        # --- Generate or Edit Image based on mode and page number ---
-        image_data = None
-        error2 = None
-
-        if use_experimental_consistency:
-            # Use cover image for page 1, previous page image for subsequent pages
-            input_image_for_edit = None
-            if page_num == 1:
-                input_image_for_edit = cover_image_data # Use cover image for the first page
-                if input_image_for_edit:
-                    print(f"--- Using Image Editing (from Cover) for Page {page_num} ---")
-                else:
-                    print(f"Warning: Experimental Consistency mode is on, but cover image data is missing. Falling back to standard generation for page {page_num}.")
-            elif page_num > 1 and previous_page_image_data:
-                input_image_for_edit = previous_page_image_data # Use previous page image
-                print(f"--- Using Image Editing (from Previous Page) for Page {page_num} ---")
-            else:
-                print(f"Warning: Experimental Consistency mode is on, but previous page image data is missing for page {page_num}. Falling back to standard generation.")
-
-            if input_image_for_edit:
-                 image_data, error2 = edit_image_from_prompt(
-                     input_image_for_edit,
-                     prompt_text=image_prompt,
-                     size="1536x1024", # Keep wide format for pages
-                     quality="high"
-                 )
-            else:
-                 # Fallback to standard generation if input image for edit is missing
-                 image_data, error2 = generate_image_from_prompt(
-                     prompt_text=image_prompt,
-                     size="1536x1024", # Keep wide format for pages
-                     quality="high"
-                 )
-        else:
-            # Standard generation mode
-            print(f"--- Using Standard Image Generation for Page {page_num} ---")
-            image_data, error2 = generate_image_from_prompt(
-                prompt_text=image_prompt,
-                size="1536x1024", # Keep wide format for pages
-                quality="high"
+        if use_experimental_consistency and cover_future:
+            # Page 1 edits the cover, so a failed cover is retried before anything else is queued.
+            # The single worker is idle once the cover is done, so the chain can be set directly.
+            cover_error = collect_cover_image(cover_future)
+            cover_future = None
+            if cover_error:
+                consistency_chain["image_path"] = retry_cover_image(
+                    book_dir, cover_prompt, cover_error, args.size, args.quality, on_retry
+                )
+        if use_experimental_consistency and last_edit_page is not None:
+            # Likewise, a failed page is retried before the next page edits it. Stage 1 for this
+            # page already overlapped with the previous edit, so only the retry itself waits.
+            resolved_page_results[last_edit_page] = resolve_page_edit(
+                book_dir, last_edit_page, page_prompts[last_edit_page], page_image_futures[last_edit_page],
+                consistency_chain, args.size, args.quality, on_retry
             )
+            last_edit_page = None
 
-        # --- Interactive Retry Loop for Image Generation/Editing Errors ---
-        while error2:
-            print(f"\n--- Image Generation/Editing Failed for Page {page_num} ---")
-            print(f"Error: {error2}")
-            print("\n--- Failed Prompt ---")
-            print(image_prompt)
-            print("--------------------")
-
-            try:
-                user_response = get_user_input("Enter revised prompt (or type 'SKIP' to skip image for this page): ").strip() # Use get_user_input
-            except EOFError:
-                print("\nNo input received, skipping image for this page.")
-                user_response = "SKIP" # Treat EOF as skip
-
-            if user_response.upper() == 'SKIP':
-                print(f"Skipping image generation/editing for page {page_num}.")
-                image_data = None # Ensure no image is saved
-                error2 = None # Break the loop
-                all_pages_successful = False # Mark as not fully successful
-            else:
-                print("Retrying image generation/editing with revised prompt...")
-                image_prompt = user_response # Update the prompt
-                # Retry using the same method (generate or edit) that failed
-                if use_experimental_consistency and input_image_for_edit: # Check if we were attempting edit
-                     image_data, error2 = edit_image_from_prompt(
-                         input_image_for_edit, # Use the same input image as before
-                         prompt_text=image_prompt,
-                         size="1536x1024",
-                         quality="high"
-                     )
-                else: # Otherwise, retry standard generation
-                     image_data, error2 = generate_image_from_prompt(
-                         prompt_text=image_prompt,
-                         size="1536x1024",
-                         quality="high"
-                     )
-                # Loop continues if error2 is still present after retry
-
-        # --- Save Image (if successful or not skipped) ---
-        if image_data:
-            # Save the image
-            output_filename = os.path.join(book_dir, f"page_{page_num:02d}.png")
-            try:
-                with open(output_filename, "wb") as f:
-                    f.write(image_data)
-                print(f"--- Stage 2 Success: Page {page_num} image saved successfully as {output_filename} ---")
+        if page_num in existing_images:
+            print(f"--- Skipping image for Page {page_num}, it already exists. ---")
+            if use_experimental_consistency:
+                # The next page edits this image; queued so it takes effect after the pages before it
+                image_executor.submit(consistency_chain.update, image_path=page_image_path(book_dir, page_num))
+            continue
 
-                # If experimental consistency is on, store this image data for the next page
-                if use_experimental_consistency:
-                    previous_page_image_data = image_data # Store current page's image data
+        # --- Generate or Edit Image based on mode and page number ---
+        if not use_experimental_consistency:
+            # Pages are independent in standard mode; only Stage 1 has to wait for the previous page
+            page_prompts[page_num] = image_prompt
+            if image_prompt in first_page_by_prompt:
+                print(f"--- Page {page_num} has the same image prompt as page {first_page_by_prompt[image_prompt]}; reusing its image. ---")
+                continue
+            first_page_by_prompt[image_prompt] = page_num
+            if image_executor:
+                page_image_futures[page_num] = image_executor.submit(
+                    generate_and_save_page_image, book_dir, page_num, image_prompt, args.size, args.quality
+                )
+                print(f"--- Image for Page {page_num} started in the background. ---")
+            continue
 
-            except IOError as e:
-                print(f"Error saving image {output_filename}: {e}")
+        # Consistency mode edits the previous image, so pages queue on the single worker
+        page_prompts[page_num] = image_prompt
+        page_image_futures[page_num] = image_executor.submit(
+            edit_and_save_page_image, book_dir, page_num, image_prompt, consistency_chain, args.size, args.quality
+        )
+        last_edit_page = page_num
+        print(f"--- Image for Page {page_num} queued in the background. ---")
+
+    # --- Stage 2: Collect the cover and page images ---
+    page_results = {}
+    cover_error = None
+    if batch_images and (page_prompts or cover_prompt):
+        print(f"\n--- Submitting {len(first_page_by_prompt)} page images{' and the cover' if cover_prompt else ''} as a batch ---")
+        unique_page_prompts = {page_num: image_prompt for image_prompt, page_num in first_page_by_prompt.items()}
+        batch_results, cover_result = asyncio.run(
+            generate_page_images_batch(unique_page_prompts, args.size, args.quality, cover_prompt=cover_prompt)
+        )
+        for page_num, (image_data, error2) in batch_results.items():
+            page_results[page_num] = (False, error2, None) if error2 else (save_page_image(book_dir, page_num, image_data), None, None)
+        if cover_result:
+            cover_image_data, cover_error = cover_result
+            if not cover_error:
+                save_cover_image(book_dir, cover_image_data)
+    elif cover_future:
+        cover_error = collect_cover_image(cover_future)
+    # A failed cover gets the interactive retry before any page (consistency mode retries it
+    # in the loop instead, before page 1's edit is queued)
+    if cover_error:
+        retry_cover_image(book_dir, cover_prompt, cover_error, args.size, args.quality, on_retry)
+
+    if page_prompts:
+        if not batch_images:
+            print(f"\n--- Waiting for {len(page_prompts)} page images ---")
+            page_results = collect_page_images(page_image_futures)
+            page_results.update(resolved_page_results)
+        # Pages that failed to generate get the interactive retry, in page order
+        saved_pages = set()
+        for page_num, image_prompt in page_prompts.items():
+            first_page = first_page_by_prompt.get(image_prompt, page_num) # Only standard mode reuses images
+            if first_page != page_num:
+                saved = first_page in saved_pages and copy_page_image(book_dir, first_page, page_num)
+            else:
+                saved, error2, input_image_for_edit = page_results[page_num]
+                if error2:
+                    image_data = retry_page_image(
+                        page_num, image_prompt, error2, input_image_for_edit,
+                        size=args.size, quality=args.quality, on_retry=on_retry
+                    )
+                    saved = bool(image_data) and save_page_image(book_dir, page_num, image_data)
+            if saved:
+                saved_pages.add(page_num)
+            else:
                 all_pages_successful = False
-                # If saving fails in consistency mode, the next page won't have the previous image.
-                # This is handled by the fallback in the generation/editing logic.
-
-        # Optional delay
-        # time.sleep(1)
+    if image_executor:
+        image_executor.shutdown()
 
     # --- Completion ---
     end_time = time.time()
@@ -434,9 +889,8 @@ def main():
         print("Some pages may have encountered errors during generation or saving.")
     print(f"Your book pages are located in: {book_dir}")
     print(f"Total time taken: {end_time - start_time:.2f} seconds")
+    if cache.CACHE_ENABLED:
+        print(f"Cache: {cache.CACHE_STATS['hits']} hits, {cache.CACHE_STATS['misses']} misses")
 
 if __name__ == "__main__":
-    main()
-
-if __name__ == "__main__":
-    main()
+    main(parse_args())
@@ -1,10 +1,10 @@
 import requests
 import os
-import base64
 import re
 import json
+import orjson
 from dotenv import load_dotenv
-from utils import sanitize_filename
+from utils import sanitize_filename, write_base64_file
 
 # --- Load Environment Variables ---
 load_dotenv()
@@ -17,6 +17,9 @@ IMAGE_QUALITY = "high" # Options: high, medium, low
 IMAGE_SIZE = "1024x1024" # Options: 1024x1024, 1536x1024, 1024x1536, auto
 OUTPUT_FORMAT = "png" # Options: png, jpeg, webp
 
+# Kept-alive connections are reused when generate_image is called more than once
+http_session = requests.Session()
+
 # --- Utility Functions ---
 def check_api_key():
     """Checks if the API key is available."""
@@ -34,7 +37,7 @@ def generate_image(prompt_text):
         prompt_text (str): The text prompt for the image generation.
 
     Returns:
-        bytes or None: The image data as bytes if successful, otherwise None.
+        str or None: The base64-encoded image data if successful, otherwise None.
         str or None: An error message if unsuccessful, otherwise None.
     """
     if not check_api_key():
@@ -60,19 +63,18 @@ def generate_image(prompt_text):
     print(f"Quality: {IMAGE_QUALITY}, Size: {IMAGE_SIZE}, Format: {OUTPUT_FORMAT}")
 
     try:
-        response = requests.post(IMAGE_API_URL, headers=headers, json=payload)
+        response = http_session.post(IMAGE_API_URL, headers=headers, json=payload)
         response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
 
-        response_data = response.json()
+        response_data = orjson.loads(response.content) # Much faster than json for the multi-MB b64_json body
 
         # Check response structure (gpt-image-1 specific)
         if "data" in response_data and len(response_data["data"]) > 0 and "b64_json" in response_data["data"][0]:
             b64_image_data = response_data["data"][0]["b64_json"]
-            image_bytes = base64.b64decode(b64_image_data)
             print("--- Image successfully generated ---")
             if "usage" in response_data:
                 print(f"Image API Usage Info: {response_data['usage']}")
-            return image_bytes, None
+            return b64_image_data, None # Decoded while saving, a chunk at a time
         else:
             error_msg = "Error: Unexpected Images API response format. 'b64_json' not found."
             print(error_msg)
@@ -84,14 +86,9 @@ def generate_image(prompt_text):
         print(error_msg)
         if e.response is not None:
             print(f"Status Code: {e.response.status_code}")
-            try:
-                error_details = json.dumps(e.response.json(), indent=2)
-                print("Error Response:", error_details)
-                error_msg += f"\nDetails: {error_details}"
-            except json.JSONDecodeError:
-                error_details = e.response.text
-                print("Error Response (non-JSON):", error_details)
-                error_msg += f"\nDetails: {error_details}"
+            error_details = e.response.text # Logged as sent; no need to parse and re-serialize it
+            print("Error Response:", error_details)
+            error_msg += f"\nDetails: {error_details}"
         return None, error_msg
 
     except Exception as e:
@@ -100,7 +97,7 @@ def generate_image(prompt_text):
         return None, error_msg
 
 def save_image(image_data, original_prompt):
-    """Saves the image data to a file in the root directory."""
+    """Decodes the base64 image data from generate_image into a file in the root directory."""
     if not image_data:
         print("No image data to save.")
         return
@@ -116,10 +113,9 @@ def save_image(image_data, original_prompt):
         counter += 1
 
     try:
-        with open(output_filename, "wb") as f:
-            f.write(image_data)
+        write_base64_file(output_filename, image_data)
         print(f"--- Image saved successfully as {output_filename} ---")
-    except IOError as e:
+    except (IOError, ValueError) as e: # ValueError: invalid base64 data
         print(f"Error saving image {output_filename}: {e}")
 
 # --- Main Execution ---
@@ -140,13 +136,13 @@ if __name__ == "__main__":
         exit(1)
 
     # Generate image
-    image_bytes, error = generate_image(user_prompt)
+    image_b64, error = generate_image(user_prompt)
 
     # Save image if generation was successful
     if error:
         print(f"\nImage generation failed: {error}")
-    elif image_bytes:
-        save_image(image_bytes, user_prompt)
+    elif image_b64:
+        save_image(image_b64, user_prompt)
     else:
         print("\nImage generation failed for an unknown reason.")
 
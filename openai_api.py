@@ -1,9 +1,21 @@
 import requests
 import os
+import asyncio
+import random
+import time
+import io
 import base64
+import hashlib
+from pathlib import Path
+from types import MappingProxyType
 from dotenv import load_dotenv
 import json
-from openai import OpenAI # Added for Chat Completions
+import orjson
+import httpx
+from openai import OpenAI, AsyncOpenAI, APIStatusError, DefaultHttpxClient, DefaultAsyncHttpxClient # Added for Chat Completions
+from openai import RateLimitError, APITimeoutError, APIConnectionError, InternalServerError
+from cache import image_cache_key, edit_cache_key, get_cached_image, store_cached_image
+from cache import structure_cache_key, get_cached_structure, store_cached_structure
 
 # --- Load Environment Variables ---
 load_dotenv()
@@ -13,39 +25,173 @@ API_KEY = os.getenv("OPENAI_API_KEY")
 IMAGE_API_URL = "https://api.openai.com/v1/images/generations"
 PROMPTS_FILE = "prompts.json"
 
-# --- Initialize OpenAI Client (for Chat Completions) ---
-# Ensure API key is available before initializing client
+# gpt-image-1 only returns base64 data, so images arrive in the API response itself.
+# One session keeps those connections alive across pages (and CLI worker threads)
+# instead of paying a new TLS handshake for every image.
+http_session = requests.Session()
+http_session.mount("https://", requests.adapters.HTTPAdapter(pool_connections=4, pool_maxsize=16))
+
+# Connections stay open between pages; Stage 1 calls can be more than httpx's default 5s apart
+HTTP_KEEPALIVE_EXPIRY = 60
+
+def create_http_client():
+    """
+    Builds the pooled HTTP/2 client behind the sync OpenAI client.
+
+    Built once at import, so every Stage 1 call and CLI worker thread reuses the same
+    kept-alive TLS connections, even if check_api_key has to create the client later.
+    """
+    return DefaultHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=20, max_keepalive_connections=10, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+    )
+
+http_client = create_http_client()
+
+# --- Initialize OpenAI Clients ---
+# The sync client serves the CLI; the async client is shared by the API server so
+# concurrent requests reuse one connection pool.
+# Ensure API key is available before initializing clients
 if API_KEY and API_KEY != "YOUR_API_KEY_HERE":
-    client = OpenAI(api_key=API_KEY)
+    client = OpenAI(api_key=API_KEY, http_client=http_client, max_retries=0) # Retries are handled by _call_with_retries
+    async_client = AsyncOpenAI(api_key=API_KEY, max_retries=0) # Retries are handled by _acall_with_retries
 else:
     client = None # Will be checked later
+    async_client = None
+
+def create_async_http_client():
+    """
+    Builds a pooled HTTP/2 client for the async OpenAI calls.
+
+    Concurrent page requests are multiplexed over a few kept-alive connections
+    instead of each opening its own TLS session. The caller owns (and closes) it.
+    """
+    return DefaultAsyncHttpxClient(
+        http2=True,
+        limits=httpx.Limits(max_connections=50, max_keepalive_connections=20, keepalive_expiry=HTTP_KEEPALIVE_EXPIRY)
+    )
+
+def configure_async_client(http_client):
+    """Rebuilds the shared async client on top of the given HTTP client."""
+    global async_client
+    if API_KEY and API_KEY != "YOUR_API_KEY_HERE":
+        async_client = AsyncOpenAI(api_key=API_KEY, http_client=http_client, max_retries=0)
+
+# --- Retry Helpers ---
+# Errors worth retrying: rate limits, timeouts, dropped connections and 5xx responses
+TRANSIENT_ERRORS = (RateLimitError, APITimeoutError, APIConnectionError, InternalServerError)
+MAX_ATTEMPTS = 5
+RETRY_BASE_DELAY = 1 # Upper bound (seconds) of the first retry's jittered delay; doubles each attempt
+RETRY_MAX_DELAY = 30
+# HTTP statuses worth retrying for the Images API calls made with requests
+TRANSIENT_STATUS_CODES = {408, 429, 500, 502, 503, 504}
+
+def _retry_delay(attempt, error=None):
+    """
+    Returns the delay (in seconds) before retrying the given attempt.
+
+    Rate-limit responses say when capacity frees up (retry-after-ms / retry-after), so
+    that wait is honoured, up to RETRY_MAX_DELAY; otherwise full-jitter exponential backoff.
+    """
+    response = getattr(error, "response", None)
+    if response is not None:
+        headers = response.headers
+        try:
+            if headers.get("retry-after-ms"):
+                return min(RETRY_MAX_DELAY, float(headers["retry-after-ms"]) / 1000)
+            if headers.get("retry-after"):
+                return min(RETRY_MAX_DELAY, float(headers["retry-after"]))
+        except ValueError:
+            pass # An HTTP date rather than seconds; fall back to backoff
+    return random.uniform(0, min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * 2 ** (attempt - 1)))
+
+def _is_transient_error(e):
+    """Returns True for OpenAI client or requests errors that are likely to succeed on retry."""
+    if isinstance(e, TRANSIENT_ERRORS):
+        return True
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    return isinstance(e, requests.exceptions.HTTPError) and e.response is not None \
+        and e.response.status_code in TRANSIENT_STATUS_CODES
+
+def _call_with_retries(description, api_call, **kwargs):
+    """
+    Calls api_call(**kwargs), retrying transient errors with exponential backoff and jitter.
+
+    Blocking counterpart of _acall_with_retries for the CLI, so rate limits and 5xx
+    responses are absorbed before the user is asked to revise a prompt.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return api_call(**kwargs)
+        except Exception as e:
+            if attempt == MAX_ATTEMPTS or not _is_transient_error(e):
+                raise
+            delay = _retry_delay(attempt, e)
+            print(f"Transient error during {description} (attempt {attempt}/{MAX_ATTEMPTS}): {e}. Retrying in {delay:.1f}s...")
+            time.sleep(delay)
+
+def _post_checked(url, files=None, **kwargs):
+    """POSTs with requests and raises HTTPError for 4xx/5xx responses."""
+    if files:
+        for file in files.values():
+            file.seek(0) # A previous attempt may have consumed the upload
+    response = http_session.post(url, files=files, **kwargs)
+    response.raise_for_status()
+    return response
+
+async def _acall_with_retries(description, api_call, **kwargs):
+    """
+    Awaits api_call(**kwargs), retrying transient errors with exponential backoff and jitter.
+
+    The last error is re-raised once MAX_ATTEMPTS is reached; other errors are raised immediately.
+    """
+    for attempt in range(1, MAX_ATTEMPTS + 1):
+        try:
+            return await api_call(**kwargs)
+        except TRANSIENT_ERRORS as e:
+            if attempt == MAX_ATTEMPTS:
+                raise
+            delay = _retry_delay(attempt, e)
+            print(f"Transient error during {description} (attempt {attempt}/{MAX_ATTEMPTS}): {e}. Retrying in {delay:.1f}s...")
+            await asyncio.sleep(delay)
 
 # --- Utility Functions ---
 def load_prompts():
-    """Loads prompt templates from the JSON file."""
+    """
+    Loads prompt templates from the JSON file.
+
+    Returns a read-only view, so the prompts can be shared between threads and
+    requests without one of them accidentally changing another's templates.
+    """
     try:
-        with open(PROMPTS_FILE, 'r') as f:
-            return json.load(f)
+        with open(PROMPTS_FILE, 'rb') as f:
+            prompts = orjson.loads(f.read())
     except FileNotFoundError:
         print(f"Error: Prompts file '{PROMPTS_FILE}' not found.")
         return None
-    except json.JSONDecodeError as e:
+    except orjson.JSONDecodeError as e:
         print(f"Error decoding JSON from '{PROMPTS_FILE}': {e}")
         return None
+    if not isinstance(prompts, dict):
+        print(f"Error: '{PROMPTS_FILE}' must contain a JSON object of prompts.")
+        return None
+    return MappingProxyType(prompts)
 
 PROMPTS = load_prompts() # Load prompts when module is imported
 
 def check_api_key():
     """Checks if the API key is available and valid."""
-    global client # Allow modification if key was missing initially
+    global client, async_client # Allow modification if key was missing initially
     if not API_KEY or API_KEY == "YOUR_API_KEY_HERE":
         print("Error: OPENAI_API_KEY not found or not set in .env file.")
         print("Please add your API key to the .env file.")
         return False
-    # Initialize client if it wasn't initialized due to missing key at import time
-    if client is None:
+    # Initialize clients if they weren't initialized due to missing key at import time
+    if client is None or async_client is None:
          try:
-             client = OpenAI(api_key=API_KEY)
+             client = OpenAI(api_key=API_KEY, http_client=http_client, max_retries=0)
+             async_client = AsyncOpenAI(api_key=API_KEY, max_retries=0)
              print("OpenAI client initialized successfully.")
          except Exception as e:
              print(f"Error initializing OpenAI client: {e}")
@@ -53,6 +199,104 @@ def check_api_key():
     return True
 
 # --- Stage 1: Text Generation (Single Page with History) ---
+def _prepare_page_request(characters, story_outline, page_number, message_history, total_pages, style_type):
+    """
+    Builds the message list for a single page's Stage 1 request.
+
+    Returns:
+        list or None: The history to send, including the request for this page.
+        str or None: The text key expected in the response ('page_text' or 'script_text').
+        str or None: An error message if the prompt could not be built, otherwise None.
+    """
+    # Select the appropriate Stage 1 prompt based on style type
+    if style_type == "narrative":
+        prompt_key = 'stage1_text_generation_narrative_page'
+        expected_text_key = 'script_text'
+        print("Using narrative text generation prompt.")
+    else: # Default to childrens
+        prompt_key = 'stage1_text_generation_single_page'
+        expected_text_key = 'page_text'
+        print("Using childrens text generation prompt.")
+
+    try:
+        stage1_prompts = PROMPTS[prompt_key]
+        system_msg = stage1_prompts['system_message']
+        prompt_template = stage1_prompts['user_prompt_template']
+    except KeyError:
+         return None, None, f"Could not find prompt key '{prompt_key}' in prompts.json"
+
+    # Build the user message for the current page request. The history is append-only:
+    # the system message and the page 1 prompt (characters, outline, page count) stay
+    # byte-identical for the whole book and later pages only add a short request at
+    # the tail, so OpenAI's automatic prompt caching reuses the growing prefix.
+    if page_number == 1:
+        # Initial prompt for the first page
+        characters_json_str = orjson.dumps(characters, option=orjson.OPT_INDENT_2).decode()
+        try:
+            user_prompt = prompt_template.format(
+                characters_json=characters_json_str,
+                story_outline=story_outline,
+                page_number=page_number,
+                total_pages=total_pages
+            )
+        except Exception as e:
+             print(f"Error formatting initial prompt for page {page_number}: {e}")
+             raise
+        # Start the history
+        current_history = [
+            {"role": "system", "content": system_msg},
+            {"role": "user", "content": user_prompt}
+        ]
+    else:
+        # Subsequent prompts just ask for the next page
+        # The history already contains system msg, initial prompt, and previous page responses
+        current_history = list(message_history) # Work with a copy
+        next_page_request = f"Now generate ONLY the JSON object for page {page_number}, continuing the story logically."
+        current_history.append({"role": "user", "content": next_page_request})
+
+    return current_history, expected_text_key, None
+
+def _prompt_cache_key(current_history):
+    """
+    Derives a prompt cache key from the invariant start of a Stage 1 conversation.
+
+    Every page of a book re-sends the same system message and initial characters/outline
+    prompt, so keying on them routes all of a book's requests to the same cached prefix.
+    """
+    prefix = orjson.dumps(current_history[:2], option=orjson.OPT_SORT_KEYS)
+    return "skryb-stage1-" + hashlib.sha256(prefix).hexdigest()[:32]
+
+def _parse_page_response(content, page_number, expected_text_key, current_history):
+    """
+    Records the assistant's reply in the history and parses it into the page structure.
+
+    Returns the same (page_data, history, error) triple as generate_single_page_structure.
+    """
+    print(f"--- Received structure response for page {page_number} ---")
+
+    # Add the assistant's response to the history for the *next* iteration
+    current_history.append({"role": "assistant", "content": content})
+
+    # Attempt to parse the JSON content (expecting a single object)
+    try:
+        page_data = orjson.loads(content)
+        # Validate the single object structure based on expected text key
+        if isinstance(page_data, dict) and \
+           "page_number" in page_data and \
+           "scene_description" in page_data and \
+           expected_text_key in page_data and \
+           page_data["page_number"] == page_number:
+             print(f"--- Page {page_number} structure parsed successfully ({expected_text_key} found) ---")
+             return page_data, current_history, None # Return updated history
+        else:
+             raise ValueError(f"Parsed JSON for page {page_number} has incorrect structure, missing '{expected_text_key}', or page number mismatch.")
+
+    except (orjson.JSONDecodeError, ValueError) as e:
+        error_msg = f"Error parsing JSON response for page {page_number}: {e}"
+        print(error_msg)
+        print("Raw Content:", repr(content))
+        return None, current_history, error_msg # Return history even on error
+
 def generate_single_page_structure(characters, story_outline, page_number, message_history, total_pages=10, model="gpt-4o", style_type="childrens"):
     """
     Generates the structure (scene description, page text OR script text) for a single page
@@ -80,83 +324,115 @@ def generate_single_page_structure(characters, story_outline, page_number, messa
     current_history = list(message_history) # Work with a copy
 
     try:
-        # Select the appropriate Stage 1 prompt based on style type
-        if style_type == "narrative":
-            prompt_key = 'stage1_text_generation_narrative_page'
-            expected_text_key = 'script_text'
-            print("Using narrative text generation prompt.")
-        else: # Default to childrens
-            prompt_key = 'stage1_text_generation_single_page'
-            expected_text_key = 'page_text'
-            print("Using childrens text generation prompt.")
+        current_history, expected_text_key, prompt_error = _prepare_page_request(
+            characters, story_outline, page_number, message_history, total_pages, style_type
+        )
+        if prompt_error:
+            return None, message_history, prompt_error
 
-        try:
-            stage1_prompts = PROMPTS[prompt_key]
-            system_msg = stage1_prompts['system_message']
-            prompt_template = stage1_prompts['user_prompt_template']
-        except KeyError:
-             return None, message_history, f"Could not find prompt key '{prompt_key}' in prompts.json"
-
-        # Build the user message for the current page request
-        if page_number == 1:
-            # Initial prompt for the first page
-            characters_json_str = json.dumps(characters, indent=2)
-            try:
-                user_prompt = prompt_template.format(
-                    characters_json=characters_json_str,
-                    story_outline=story_outline,
-                    page_number=page_number,
-                    total_pages=total_pages
-                )
-            except Exception as e:
-                 print(f"Error formatting initial prompt for page {page_number}: {e}")
-                 raise
-            # Start the history
-            current_history = [
-                {"role": "system", "content": system_msg},
-                {"role": "user", "content": user_prompt}
-            ]
-        else:
-            # Subsequent prompts just ask for the next page
-            # The history already contains system msg, initial prompt, and previous page responses
-            next_page_request = f"Now generate ONLY the JSON object for page {page_number}, continuing the story logically."
-            current_history.append({"role": "user", "content": next_page_request})
+        cache_key = structure_cache_key(model, current_history)
+        cached_content = get_cached_structure(cache_key)
+        if cached_content:
+            print(f"--- Using cached structure for page {page_number} ---")
+            return _parse_page_response(cached_content, page_number, expected_text_key, current_history)
 
         print(f"\n--- Sending request to Chat Completions API for page {page_number} structure ---")
         # print("DEBUG History:", current_history) # Optional: print history being sent
 
-        response = client.chat.completions.create(
+        response = _call_with_retries(
+            f"page {page_number} structure",
+            client.chat.completions.create,
             model=model,
             messages=current_history, # Send the whole history
             response_format={"type": "json_object"},
-            max_tokens=1000 # Should be enough for one page's JSON
+            max_tokens=1000, # Should be enough for one page's JSON
+            prompt_cache_key=_prompt_cache_key(current_history) # History only grows, so its prefix stays cacheable
         )
 
+        _log_prompt_cache_usage(response, page_number)
         content = response.choices[0].message.content
-        print(f"--- Received structure response for page {page_number} ---")
+        page_data, current_history, parse_error = _parse_page_response(content, page_number, expected_text_key, current_history)
+        if not parse_error:
+            store_cached_structure(cache_key, content)
+        return page_data, current_history, parse_error
+
+    except Exception as e:
+        error_msg = f"Error during Chat Completions API request for page {page_number}: {e}"
+        print(error_msg)
+        return None, current_history, error_msg # Return history even on error
 
-        # Add the assistant's response to the history for the *next* iteration
-        current_history.append({"role": "assistant", "content": content})
+def _log_prompt_cache_usage(response, page_number):
+    """Prints how much of a Stage 1 prompt OpenAI served from its prompt cache (the stable history prefix)."""
+    usage = getattr(response, "usage", None)
+    details = getattr(usage, "prompt_tokens_details", None)
+    if usage and details and details.cached_tokens is not None:
+        print(f"Page {page_number} prompt tokens: {usage.prompt_tokens} ({details.cached_tokens} cached)")
 
-        # Attempt to parse the JSON content (expecting a single object)
-        try:
-            page_data = json.loads(content)
-            # Validate the single object structure based on expected text key
-            if isinstance(page_data, dict) and \
-               "page_number" in page_data and \
-               "scene_description" in page_data and \
-               expected_text_key in page_data and \
-               page_data["page_number"] == page_number:
-                 print(f"--- Page {page_number} structure parsed successfully ({expected_text_key} found) ---")
-                 return page_data, current_history, None # Return updated history
-            else:
-                 raise ValueError(f"Parsed JSON for page {page_number} has incorrect structure, missing '{expected_text_key}', or page number mismatch.")
+def replay_single_page_structure(characters, story_outline, page_number, message_history, content, total_pages=10, style_type="childrens"):
+    """
+    Rebuilds a page's Stage 1 result from a previously saved response without calling the API,
+    so a resumed book continues the same conversation history.
 
-        except (json.JSONDecodeError, ValueError) as e:
-            error_msg = f"Error parsing JSON response for page {page_number}: {e}"
-            print(error_msg)
-            print("Raw Content:", repr(content))
-            return None, current_history, error_msg # Return history even on error
+    Args:
+        content (str): The assistant response saved when the page was first generated.
+        The other arguments are the same as for generate_single_page_structure.
+
+    Returns the same (page_data, history, error) triple as generate_single_page_structure.
+    """
+    if not PROMPTS:
+        return None, message_history, "Prompts could not be loaded."
+
+    current_history, expected_text_key, prompt_error = _prepare_page_request(
+        characters, story_outline, page_number, message_history, total_pages, style_type
+    )
+    if prompt_error:
+        return None, message_history, prompt_error
+    print(f"--- Using saved structure for page {page_number} ---")
+    return _parse_page_response(content, page_number, expected_text_key, current_history)
+
+async def agenerate_single_page_structure(characters, story_outline, page_number, message_history, total_pages=10, model="gpt-4o", style_type="childrens"):
+    """
+    Async variant of generate_single_page_structure, backed by the shared AsyncOpenAI client.
+    Takes the same arguments and returns the same (page_data, history, error) triple.
+    """
+    if not check_api_key() or async_client is None:
+        return None, message_history, "API key not configured or client not initialized."
+    if not PROMPTS:
+        return None, message_history, "Prompts could not be loaded."
+
+    current_history = list(message_history) # Work with a copy
+
+    try:
+        current_history, expected_text_key, prompt_error = _prepare_page_request(
+            characters, story_outline, page_number, message_history, total_pages, style_type
+        )
+        if prompt_error:
+            return None, message_history, prompt_error
+
+        cache_key = structure_cache_key(model, current_history)
+        cached_content = await asyncio.to_thread(get_cached_structure, cache_key) # Disk I/O stays off the event loop
+        if cached_content:
+            print(f"--- Using cached structure for page {page_number} ---")
+            return _parse_page_response(cached_content, page_number, expected_text_key, current_history)
+
+        print(f"\n--- Sending request to Chat Completions API for page {page_number} structure ---")
+
+        response = await _acall_with_retries(
+            f"page {page_number} structure",
+            async_client.chat.completions.create,
+            model=model,
+            messages=current_history, # Send the whole history
+            response_format={"type": "json_object"},
+            max_tokens=1000, # Should be enough for one page's JSON
+            prompt_cache_key=_prompt_cache_key(current_history) # History only grows, so its prefix stays cacheable
+        )
+
+        _log_prompt_cache_usage(response, page_number)
+        content = response.choices[0].message.content
+        page_data, current_history, parse_error = _parse_page_response(content, page_number, expected_text_key, current_history)
+        if not parse_error:
+            await asyncio.to_thread(store_cached_structure, cache_key, content)
+        return page_data, current_history, parse_error
 
     except Exception as e:
         error_msg = f"Error during Chat Completions API request for page {page_number}: {e}"
@@ -164,6 +440,191 @@ def generate_single_page_structure(characters, story_outline, page_number, messa
         return None, current_history, error_msg # Return history even on error
 
 
+# --- Stage 1: History Compaction ---
+HISTORY_WINDOW_PAGES = 8 # Page responses kept verbatim once older ones are summarised
+HISTORY_SUMMARY_MODEL = "gpt-4o-mini"
+
+def _summarize_pages(previous_summary, page_responses, model):
+    """Returns a short prose summary of earlier pages (and any earlier summary), or raises on failure."""
+    parts = [f"Summary of the pages before these: {previous_summary}"] if previous_summary else []
+    parts.extend(page_responses)
+    messages = [
+        {"role": "system", "content": (
+            "You summarise the story so far of a book that is being written page by page. Keep every plot point, "
+            "character appearance and setting detail needed to continue the story consistently. "
+            "Answer in at most 200 words of plain prose."
+        )},
+        {"role": "user", "content": "\n\n".join(parts)}
+    ]
+
+    cache_key = structure_cache_key(model, messages)
+    summary = get_cached_structure(cache_key)
+    if summary:
+        return summary
+    response = _call_with_retries(
+        "history summary",
+        client.chat.completions.create,
+        model=model,
+        messages=messages,
+        max_tokens=400
+    )
+    summary = response.choices[0].message.content.strip()
+    store_cached_structure(cache_key, summary)
+    return summary
+
+def compact_message_history(message_history, window_pages=HISTORY_WINDOW_PAGES, model=HISTORY_SUMMARY_MODEL):
+    """
+    Keeps the Stage 1 history from growing with every page by summarising older pages.
+
+    Once the history holds more than 2 * window_pages page responses, all but the last
+    window_pages are replaced by one summary message. The system message and the initial
+    characters/outline prompt are always kept, and between compactions the history stays
+    append-only, so its prefix remains cacheable.
+
+    Returns:
+        list: The compacted history, or message_history unchanged if it is still short,
+        window_pages is 0, or the summary could not be generated.
+    """
+    if window_pages <= 0 or client is None or len(message_history) < 3:
+        return message_history
+
+    head, tail = message_history[:2], message_history[2:]
+    previous_summary = None
+    if tail[0]["role"] == "system": # Summary left by an earlier compaction
+        previous_summary, tail = tail[0]["content"], tail[1:]
+
+    # Group the remaining messages into pages, each ending with the assistant's response
+    pages, current_page = [], []
+    for message in tail:
+        current_page.append(message)
+        if message["role"] == "assistant":
+            pages.append(current_page)
+            current_page = []
+    if len(pages) <= 2 * window_pages:
+        return message_history
+
+    old_pages, recent_pages = pages[:-window_pages], pages[-window_pages:]
+    print(f"--- Summarising {len(old_pages)} earlier pages to shorten the Stage 1 history ---")
+    try:
+        summary = _summarize_pages(previous_summary, [page[-1]["content"] for page in old_pages], model)
+    except Exception as e:
+        print(f"Warning: Could not summarise the story history, keeping it in full: {e}")
+        return message_history
+
+    summary_message = {"role": "system", "content": f"Summary of the earlier pages of the story: {summary}"}
+    return head + [summary_message] + [message for page in recent_pages for message in page] + current_page
+
+# --- Stage 1: Text Generation (All Pages in One Request) ---
+MAX_PAGES_PER_STRUCTURE_REQUEST = 24 # Keeps the whole book's JSON well inside one response
+STRUCTURE_TOKENS_PER_PAGE = 600
+
+def generate_all_pages_structure(characters, story_outline, total_pages=10, model="gpt-4o", style_type="childrens"):
+    """
+    Generates the structure of every page in a single Chat Completions request.
+
+    Uses the same Stage 1 prompt as page 1 of generate_single_page_structure, followed
+    by a request for all pages at once, so the system message and characters/outline
+    are sent (and billed) once instead of once per page.
+
+    Returns:
+        list or None: The page dictionaries in page order if successful, otherwise None.
+        str or None: An error message if unsuccessful, otherwise None.
+    """
+    if not check_api_key() or client is None:
+        return None, "API key not configured or client not initialized."
+    if not PROMPTS:
+        return None, "Prompts could not be loaded."
+    if total_pages > MAX_PAGES_PER_STRUCTURE_REQUEST:
+        return None, f"Books longer than {MAX_PAGES_PER_STRUCTURE_REQUEST} pages are generated page by page."
+
+    try:
+        messages, expected_text_key, prompt_error = _prepare_page_request(
+            characters, story_outline, 1, [], total_pages, style_type
+        )
+        if prompt_error:
+            return None, prompt_error
+        messages.append({"role": "user", "content": (
+            f"Instead of only page 1, generate ALL {total_pages} pages now. Respond with a single JSON object "
+            f"with the key \"pages\": an array of {total_pages} objects in page order, each with exactly the "
+            f"keys described above and page_number running from 1 to {total_pages}."
+        )})
+
+        cache_key = structure_cache_key(model, messages)
+        content = get_cached_structure(cache_key)
+        if content:
+            print("--- Using cached structure for all pages ---")
+        else:
+            print(f"\n--- Sending request to Chat Completions API for all {total_pages} page structures ---")
+            response = _call_with_retries(
+                "all page structures",
+                client.chat.completions.create,
+                model=model,
+                messages=messages,
+                response_format={"type": "json_object"},
+                max_tokens=STRUCTURE_TOKENS_PER_PAGE * total_pages
+            )
+            content = response.choices[0].message.content
+
+        pages = orjson.loads(content).get("pages")
+        if not isinstance(pages, list) or len(pages) != total_pages:
+            raise ValueError(f"Expected a 'pages' array of {total_pages} objects.")
+        for page_number, page_data in enumerate(pages, start=1):
+            if not isinstance(page_data, dict) or \
+               page_data.get("page_number") != page_number or \
+               "scene_description" not in page_data or \
+               expected_text_key not in page_data:
+                raise ValueError(f"Page {page_number} has incorrect structure, missing '{expected_text_key}', or page number mismatch.")
+
+        store_cached_structure(cache_key, content)
+        print(f"--- All {total_pages} page structures parsed successfully ---")
+        return pages, None
+
+    except (orjson.JSONDecodeError, AttributeError, ValueError) as e:
+        error_msg = f"Error parsing JSON response for all pages: {e}"
+        print(error_msg)
+        return None, error_msg
+
+    except Exception as e:
+        error_msg = f"Error during Chat Completions API request for all pages: {e}"
+        print(error_msg)
+        return None, error_msg
+
+# --- Stage 2: Shared Images API Helpers ---
+def _decode_image_response(response_data, action, api_name="Images API"):
+    """
+    Extracts the base64 image from an Images API response (gpt-image-1 specific).
+
+    Returns:
+        bytes or None: The decoded image data if present, otherwise None.
+        str or None: An error message if the response had an unexpected format, otherwise None.
+    """
+    if "data" in response_data and response_data["data"] and response_data["data"][0].get("b64_json"):
+        b64_image_data = response_data["data"][0]["b64_json"]
+        image_bytes = base64.b64decode(b64_image_data)
+        print(f"--- Image successfully {action} ---")
+        # Optionally print usage info if available (gpt-image-1 provides this)
+        if response_data.get("usage"):
+            print(f"Image API Usage Info: {response_data['usage']}")
+        return image_bytes, None
+    else:
+        error_msg = f"Error: Unexpected {api_name} response format. 'b64_json' not found."
+        print(error_msg)
+        print("Full Response:", json.dumps(response_data, indent=2))
+        return None, error_msg
+
+def _describe_error_response(error_msg, response):
+    """Appends the status code and response body of a failed Images API call to error_msg."""
+    status_code = response.status_code
+    print(f"Status Code: {status_code}")
+    # Prepend specific message for potential moderation blocks
+    if status_code == 400:
+        error_msg = f"[Potential Moderation Error] {error_msg}"
+    error_details = response.text # Logged as sent; no need to parse and re-serialize it
+    print("Error Response:", error_details)
+    error_msg += f"\nDetails: {error_details}"
+    return error_msg
+
+
 # --- Stage 2: Image Generation ---
 def generate_image_from_prompt(prompt_text, size="1536x1024", quality="high"):
     """
@@ -181,6 +642,12 @@ def generate_image_from_prompt(prompt_text, size="1536x1024", quality="high"):
     if not check_api_key():
         return None, "API key not configured."
 
+    cache_key = image_cache_key(prompt_text, size, quality)
+    cached_image = get_cached_image(cache_key)
+    if cached_image:
+        print("--- Using cached image for this prompt ---")
+        return cached_image, None
+
     headers = {
         "Content-Type": "application/json",
         "Authorization": f"Bearer {API_KEY}"
@@ -201,45 +668,63 @@ def generate_image_from_prompt(prompt_text, size="1536x1024", quality="high"):
     # print(f"DEBUG Image Prompt: {repr(prompt_text)}") # Keep commented out unless needed
 
     try:
-        response = requests.post(IMAGE_API_URL, headers=headers, json=payload)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-        response_data = response.json()
-
-        # Check response structure (gpt-image-1 specific)
-        if "data" in response_data and len(response_data["data"]) > 0 and "b64_json" in response_data["data"][0]:
-            b64_image_data = response_data["data"][0]["b64_json"]
-            image_bytes = base64.b64decode(b64_image_data)
-            print("--- Image successfully generated ---")
-            # Optionally print usage info if available (gpt-image-1 provides this)
-            if "usage" in response_data:
-                print(f"Image API Usage Info: {response_data['usage']}")
-            return image_bytes, None
-        else:
-            error_msg = "Error: Unexpected Images API response format. 'b64_json' not found."
-            print(error_msg)
-            print("Full Response:", json.dumps(response_data, indent=2))
-            return None, error_msg
+        response = _call_with_retries(
+            "image generation", _post_checked, url=IMAGE_API_URL, headers=headers, json=payload
+        )
+
+        image_bytes, error_msg = _decode_image_response(orjson.loads(response.content), "generated")
+        store_cached_image(cache_key, image_bytes)
+        return image_bytes, error_msg
 
     except requests.exceptions.RequestException as e:
         error_msg = f"Error during Images API request: {e}"
         print(error_msg)
         if e.response is not None:
-            status_code = e.response.status_code
-            print(f"Status Code: {status_code}")
-            # Prepend specific message for potential moderation blocks
-            if status_code == 400:
-                error_msg = f"[Potential Moderation Error] {error_msg}"
-            try:
-                error_details = json.dumps(e.response.json(), indent=2)
-                print("Error Response:", error_details)
-                error_msg += f"\nDetails: {error_details}"
-            except json.JSONDecodeError:
-                error_details = e.response.text
-                print("Error Response (non-JSON):", error_details)
-                error_msg += f"\nDetails: {error_details}"
+            error_msg = _describe_error_response(error_msg, e.response)
+        return None, error_msg
+
+    except Exception as e:
+        error_msg = f"An unexpected error occurred during image generation: {e}"
+        print(error_msg)
         return None, error_msg
 
+async def agenerate_image_from_prompt(prompt_text, size="1536x1024", quality="high"):
+    """
+    Async variant of generate_image_from_prompt, backed by the shared AsyncOpenAI client.
+    Takes the same arguments and returns the same (image_bytes, error) pair.
+    """
+    if not check_api_key() or async_client is None:
+        return None, "API key not configured."
+
+    cache_key = image_cache_key(prompt_text, size, quality)
+    cached_image = await asyncio.to_thread(get_cached_image, cache_key) # Disk I/O stays off the event loop
+    if cached_image:
+        print("--- Using cached image for this prompt ---")
+        return cached_image, None
+
+    print(f"\n--- Sending request to OpenAI Images API ---")
+    print(f"Prompt: {prompt_text}")
+
+    try:
+        response = await _acall_with_retries(
+            "image generation",
+            async_client.images.generate,
+            model="gpt-image-1", # Hardcoded for this project
+            prompt=prompt_text,
+            n=1,
+            size=size,
+            quality=quality,
+            moderation="low" # Added to potentially bypass safety system blocks
+        )
+        image_bytes, error_msg = _decode_image_response(response.model_dump(), "generated")
+        await asyncio.to_thread(store_cached_image, cache_key, image_bytes)
+        return image_bytes, error_msg
+
+    except APIStatusError as e:
+        error_msg = f"Error during Images API request: {e}"
+        print(error_msg)
+        return None, _describe_error_response(error_msg, e.response)
+
     except Exception as e:
         error_msg = f"An unexpected error occurred during image generation: {e}"
         print(error_msg)
@@ -251,7 +736,7 @@ def edit_image_from_prompt(previous_image_data, prompt_text, size="1536x1024", q
     Edits an image using the OpenAI Images API (gpt-image-1) based on the provided prompt.
 
     Args:
-        previous_image_data (bytes): The image data of the previous page.
+        previous_image_data (bytes or str): The image data of the previous page, or the path of the saved image file.
         prompt_text (str): The detailed text prompt for the image editing.
         size (str): The desired image size (e.g., "1536x1024", "1024x1024").
         quality (str): The desired image quality ("low", "medium", "high", "auto").
@@ -263,17 +748,30 @@ def edit_image_from_prompt(previous_image_data, prompt_text, size="1536x1024", q
     if not check_api_key():
         return None, "API key not configured."
 
+    cache_key = edit_cache_key(previous_image_data, prompt_text, size, quality)
+    cached_image = get_cached_image(cache_key) if cache_key else None
+    if cached_image:
+        print("--- Using cached image for this edit ---")
+        return cached_image, None
+
     headers = {
         "Authorization": f"Bearer {API_KEY}"
     }
 
     # The /v1/images/edits endpoint requires multipart/form-data
     # We need to send the image data as a file-like object
-
-    # Create a file-like object from bytes
-    import io
-    image_file = io.BytesIO(previous_image_data)
-    image_file.name = "previous_image.png" # Give it a name, extension might matter
+    if isinstance(previous_image_data, (str, os.PathLike)):
+        # Read straight from the saved file so the caller doesn't keep the PNG in memory
+        try:
+            image_file = open(previous_image_data, "rb")
+        except OSError as e:
+            error_msg = f"Error reading previous image '{previous_image_data}': {e}"
+            print(error_msg)
+            return None, error_msg
+    else:
+        # Create a file-like object from bytes
+        image_file = io.BytesIO(previous_image_data)
+        image_file.name = "previous_image.png" # Give it a name, extension might matter
 
     files = {
         "image": image_file
@@ -295,43 +793,21 @@ def edit_image_from_prompt(previous_image_data, prompt_text, size="1536x1024", q
 
     try:
         # Use requests.post with files and data for multipart/form-data
-        response = requests.post("https://api.openai.com/v1/images/edits", headers=headers, files=files, data=data)
-        response.raise_for_status() # Raise HTTPError for bad responses (4xx or 5xx)
-
-        response_data = response.json()
-
-        # Check response structure (gpt-image-1 specific)
-        if "data" in response_data and len(response_data["data"]) > 0 and "b64_json" in response_data["data"][0]:
-            b64_image_data = response_data["data"][0]["b64_json"]
-            image_bytes = base64.b64decode(b64_image_data)
-            print("--- Image successfully edited ---")
-            # Optionally print usage info if available (gpt-image-1 provides this)
-            if "usage" in response_data:
-                print(f"Image API Usage Info: {response_data['usage']}")
-            return image_bytes, None
-        else:
-            error_msg = "Error: Unexpected Images API (Edit) response format. 'b64_json' not found."
-            print(error_msg)
-            print("Full Response:", json.dumps(response_data, indent=2))
-            return None, error_msg
+        response = _call_with_retries(
+            "image editing", _post_checked,
+            url="https://api.openai.com/v1/images/edits", headers=headers, files=files, data=data
+        )
+
+        image_bytes, error_msg = _decode_image_response(orjson.loads(response.content), "edited", api_name="Images API (Edit)")
+        if cache_key:
+            store_cached_image(cache_key, image_bytes)
+        return image_bytes, error_msg
 
     except requests.exceptions.RequestException as e:
         error_msg = f"Error during Images API (Edit) request: {e}"
         print(error_msg)
         if e.response is not None:
-            status_code = e.response.status_code
-            print(f"Status Code: {status_code}")
-            # Prepend specific message for potential moderation blocks
-            if status_code == 400:
-                error_msg = f"[Potential Moderation Error] {error_msg}"
-            try:
-                error_details = json.dumps(e.response.json(), indent=2)
-                print("Error Response:", error_details)
-                error_msg += f"\nDetails: {error_details}"
-            except json.JSONDecodeError:
-                error_details = e.response.text
-                print("Error Response (non-JSON):", error_details)
-                error_msg += f"\nDetails: {error_details}"
+            error_msg = _describe_error_response(error_msg, e.response)
         return None, error_msg
 
     except Exception as e:
@@ -339,23 +815,162 @@ def edit_image_from_prompt(previous_image_data, prompt_text, size="1536x1024", q
         print(error_msg)
         return None, error_msg
 
+    finally:
+        image_file.close()
 
-# --- Character Inference ---
-def infer_characters(story_concept, model="gpt-4o"):
+async def aedit_image_from_prompt(previous_image_data, prompt_text, size="1536x1024", quality="high"):
     """
-    Infers potential characters and descriptions based on a story concept using the Chat Completions API.
+    Async variant of edit_image_from_prompt, backed by the shared AsyncOpenAI client.
+    Takes the same arguments and returns the same (image_bytes, error) pair.
+    """
+    if not check_api_key() or async_client is None:
+        return None, "API key not configured."
+
+    cache_key = await asyncio.to_thread(edit_cache_key, previous_image_data, prompt_text, size, quality)
+    cached_image = await asyncio.to_thread(get_cached_image, cache_key) if cache_key else None
+    if cached_image:
+        print("--- Using cached image for this edit ---")
+        return cached_image, None
+
+    if isinstance(previous_image_data, (str, os.PathLike)):
+        image = Path(previous_image_data) # The SDK reads the saved file when uploading
+    else:
+        image = ("previous_image.png", previous_image_data, "image/png")
+
+    print(f"\n--- Sending request to OpenAI Images API (Edit - gpt-image-1) ---")
+    print(f"Prompt: {prompt_text}")
+
+    try:
+        response = await _acall_with_retries(
+            "image editing",
+            async_client.images.edit,
+            model="gpt-image-1", # Hardcoded for this project
+            image=image,
+            prompt=prompt_text,
+            n=1,
+            size=size,
+            quality=quality
+        )
+        image_bytes, error_msg = _decode_image_response(response.model_dump(), "edited", api_name="Images API (Edit)")
+        if cache_key:
+            await asyncio.to_thread(store_cached_image, cache_key, image_bytes)
+        return image_bytes, error_msg
+
+    except APIStatusError as e:
+        error_msg = f"Error during Images API (Edit) request: {e}"
+        print(error_msg)
+        return None, _describe_error_response(error_msg, e.response)
+
+    except Exception as e:
+        error_msg = f"An unexpected error occurred during image editing: {e}"
+        print(error_msg)
+        return None, error_msg
+
+
+# --- Stage 2: Batch Image Generation ---
+BATCH_TERMINAL_STATUSES = ("completed", "failed", "expired", "cancelled")
+
+async def asubmit_image_batch(prompts_by_id, size="1536x1024", quality="high"):
+    """
+    Submits several image generations as one OpenAI Batch API job.
 
     Args:
-        story_concept (str): A brief description of the story's theme or plot.
-        model (str): The chat model to use (e.g., "gpt-4o").
+        prompts_by_id (dict): Maps a caller-chosen custom id (e.g. "page_03") to its prompt.
+        size (str): The desired image size for every image in the batch.
+        quality (str): The desired image quality for every image in the batch.
 
     Returns:
-        dict or None: A dictionary mapping character names to descriptions if successful, otherwise None.
-        str or None: An error message if unsuccessful, otherwise None.
+        str or None: The batch id if the job was created, otherwise None.
+        str or None: An error message if submission failed, otherwise None.
     """
-    if not check_api_key() or client is None:
-        return None, "API key not configured or client not initialized."
+    if not check_api_key() or async_client is None:
+        return None, "API key not configured."
 
+    lines = []
+    for custom_id, prompt_text in prompts_by_id.items():
+        lines.append(orjson.dumps({
+            "custom_id": custom_id,
+            "method": "POST",
+            "url": "/v1/images/generations",
+            "body": {
+                "model": "gpt-image-1", # Hardcoded for this project
+                "prompt": prompt_text,
+                "n": 1,
+                "size": size,
+                "quality": quality,
+                "moderation": "low"
+            }
+        }))
+
+    print(f"\n--- Submitting {len(lines)} image requests to the OpenAI Batch API ---")
+    try:
+        input_file = await async_client.files.create(
+            file=("image_batch.jsonl", b"\n".join(lines)),
+            purpose="batch"
+        )
+        batch = await async_client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/images/generations",
+            completion_window="24h"
+        )
+        print(f"--- Batch {batch.id} created ---")
+        return batch.id, None
+
+    except Exception as e:
+        error_msg = f"Error submitting image batch: {e}"
+        print(error_msg)
+        return None, error_msg
+
+async def await_image_batch(batch_id, poll_interval=30):
+    """
+    Waits for a batch created by asubmit_image_batch and decodes its images.
+
+    Returns:
+        dict or None: Maps each custom id to an (image_bytes, error) pair, or None if the batch failed.
+        str or None: An error message if the batch did not complete, otherwise None.
+    """
+    if not check_api_key() or async_client is None:
+        return None, "API key not configured."
+
+    try:
+        batch = await async_client.batches.retrieve(batch_id)
+        while batch.status not in BATCH_TERMINAL_STATUSES:
+            await asyncio.sleep(poll_interval)
+            batch = await async_client.batches.retrieve(batch_id)
+
+        if batch.status != "completed":
+            error_msg = f"Image batch {batch_id} ended with status '{batch.status}'."
+            print(error_msg)
+            return None, error_msg
+
+        results = {}
+        # Requests the API rejected outright are listed in the error file instead
+        for file_id in (batch.output_file_id, batch.error_file_id):
+            if not file_id:
+                continue
+            content = await async_client.files.content(file_id)
+            for line in content.content.splitlines(): # Parsed as bytes; the output holds every image's base64 data
+                if not line.strip():
+                    continue
+                item = orjson.loads(line)
+                response = item.get("response") or {}
+                if item.get("error") or response.get("status_code") != 200:
+                    error_msg = f"Batch request failed: {item.get('error') or response.get('body')}"
+                    print(f"{item['custom_id']}: {error_msg}")
+                    results[item["custom_id"]] = (None, error_msg)
+                else:
+                    results[item["custom_id"]] = _decode_image_response(response["body"], "generated", api_name="Batch API")
+        return results, None
+
+    except Exception as e:
+        error_msg = f"Error while waiting for image batch {batch_id}: {e}"
+        print(error_msg)
+        return None, error_msg
+
+
+# --- Character Inference ---
+def _character_inference_messages(story_concept):
+    """Builds the chat messages used to infer characters from a story concept."""
     system_message = "You are an assistant skilled at identifying key characters from a story concept and providing brief visual descriptions suitable for an illustrator."
     user_prompt = f"""Analyze the following story concept and identify 2-4 main characters that would likely appear. For each character, provide a concise visual description (appearance, notable features, clothing style if relevant).
 
@@ -366,38 +981,85 @@ Output ONLY a single, valid JSON object mapping character names (string keys) to
   "Character Name 1": "Brief visual description...",
   "Character Name 2": "Brief visual description..."
 }}"""
+    return [
+        {"role": "system", "content": system_message},
+        {"role": "user", "content": user_prompt}
+    ]
+
+def _parse_character_response(content):
+    """Parses the character inference reply into a dict of names to descriptions."""
+    print("--- Received character inference response ---")
+
+    try:
+        character_data = orjson.loads(content)
+        # Basic validation: check if it's a dictionary with string values
+        if isinstance(character_data, dict) and all(isinstance(v, str) for v in character_data.values()):
+            print("--- Character data parsed successfully ---")
+            if not character_data:
+                 print("Warning: No characters were inferred.")
+            return character_data, None
+        else:
+            raise ValueError("Parsed JSON is not a dictionary mapping strings to strings.")
+
+    except (orjson.JSONDecodeError, ValueError) as e:
+        error_msg = f"Error parsing JSON response for character inference: {e}"
+        print(error_msg)
+        print("Raw Content:", repr(content))
+        return None, error_msg
+
+def infer_characters(story_concept, model="gpt-4o"):
+    """
+    Infers potential characters and descriptions based on a story concept using the Chat Completions API.
+
+    Args:
+        story_concept (str): A brief description of the story's theme or plot.
+        model (str): The chat model to use (e.g., "gpt-4o").
+
+    Returns:
+        dict or None: A dictionary mapping character names to descriptions if successful, otherwise None.
+        str or None: An error message if unsuccessful, otherwise None.
+    """
+    if not check_api_key() or client is None:
+        return None, "API key not configured or client not initialized."
 
     try:
         print("\n--- Sending request to Chat Completions API for character inference ---")
-        response = client.chat.completions.create(
+        response = _call_with_retries(
+            "character inference",
+            client.chat.completions.create,
             model=model,
-            messages=[
-                {"role": "system", "content": system_message},
-                {"role": "user", "content": user_prompt}
-            ],
+            messages=_character_inference_messages(story_concept),
             response_format={"type": "json_object"},
             max_tokens=500 # Should be enough for a few character descriptions
         )
 
-        content = response.choices[0].message.content
-        print("--- Received character inference response ---")
+        return _parse_character_response(response.choices[0].message.content)
 
-        try:
-            character_data = json.loads(content)
-            # Basic validation: check if it's a dictionary with string values
-            if isinstance(character_data, dict) and all(isinstance(v, str) for v in character_data.values()):
-                print("--- Character data parsed successfully ---")
-                if not character_data:
-                     print("Warning: No characters were inferred.")
-                return character_data, None
-            else:
-                raise ValueError("Parsed JSON is not a dictionary mapping strings to strings.")
+    except Exception as e:
+        error_msg = f"Error during Chat Completions API request for character inference: {e}"
+        print(error_msg)
+        return None, error_msg
 
-        except (json.JSONDecodeError, ValueError) as e:
-            error_msg = f"Error parsing JSON response for character inference: {e}"
-            print(error_msg)
-            print("Raw Content:", repr(content))
-            return None, error_msg
+async def ainfer_characters(story_concept, model="gpt-4o"):
+    """
+    Async variant of infer_characters, backed by the shared AsyncOpenAI client.
+    Takes the same arguments and returns the same (characters, error) pair.
+    """
+    if not check_api_key() or async_client is None:
+        return None, "API key not configured or client not initialized."
+
+    try:
+        print("\n--- Sending request to Chat Completions API for character inference ---")
+        response = await _acall_with_retries(
+            "character inference",
+            async_client.chat.completions.create,
+            model=model,
+            messages=_character_inference_messages(story_concept),
+            response_format={"type": "json_object"},
+            max_tokens=500 # Should be enough for a few character descriptions
+        )
+
+        return _parse_character_response(response.choices[0].message.content)
 
     except Exception as e:
         error_msg = f"Error during Chat Completions API request for character inference: {e}"
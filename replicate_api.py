@@ -1,5 +1,6 @@
 import os
 import time
+import requests
 import replicate
 from dotenv import load_dotenv
 
@@ -7,6 +8,15 @@ load_dotenv()
 
 REPLICATE_API_TOKEN = os.getenv("REPLICATE_API_TOKEN")
 
+# Prediction polling starts quickly and backs off, so fast predictions are picked up
+# sooner and long ones aren't polled every couple of seconds
+POLL_INITIAL_DELAY = 0.25
+POLL_MAX_DELAY = 4
+POLL_BACKOFF = 1.5
+
+# Reused for downloading finished images, so pages share kept-alive connections to the delivery host
+download_session = requests.Session()
+
 def check_replicate_api_key():
     """Check if the Replicate API key is configured."""
     return bool(REPLICATE_API_TOKEN)
@@ -39,8 +49,10 @@ def generate_image_with_replicate(prompt_text: str, input_image: str | None = No
         )
 
         # Step 2: Poll for the prediction result
+        poll_delay = POLL_INITIAL_DELAY
         while prediction.status not in ["succeeded", "failed", "canceled"]:
-            time.sleep(2) # Wait for 2 seconds before checking again
+            time.sleep(poll_delay)
+            poll_delay = min(poll_delay * POLL_BACKOFF, POLL_MAX_DELAY)
             prediction = replicate.predictions.get(prediction.id)
 
         # Step 3: Handle the result
@@ -50,8 +62,7 @@ def generate_image_with_replicate(prompt_text: str, input_image: str | None = No
                 image_url = image_url[0]
 
             if image_url and isinstance(image_url, str):
-                import requests
-                response = requests.get(image_url)
+                response = download_session.get(image_url, timeout=60)
                 response.raise_for_status()
                 return response.content, None
             else:
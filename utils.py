@@ -1,10 +1,122 @@
+import os
 import re
+import io
+import base64
+import string
+from PIL import Image
+
+_SANITIZE_INVALID = str.maketrans('', '', '<>:"/\\|?*') # Deleted in one pass by str.translate
+_SANITIZE_WS = re.compile(r'[\s.,;!]+')
 
 def sanitize_filename(name):
     """Removes or replaces characters invalid for filenames/directory names."""
-    name = re.sub(r'[<>:"/\\|?*]', '', name)
-    name = re.sub(r'[\s.,;!]+', '_', name)
-    return name[:100]
+    return _SANITIZE_WS.sub('_', name.translate(_SANITIZE_INVALID))[:100]
+
+def compile_prompt_template(template):
+    """
+    Parses a str.format-style prompt template once and returns a function that fills it.
+
+    The returned function takes the same keyword arguments as template.format (and raises
+    KeyError for a missing field), but each call only joins the pre-split text and values.
+    Templates using conversions, format specs or positional fields fall back to template.format.
+    """
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError:
+        return template.format # Malformed template: let the call report it as before
+
+    parts = []
+    for literal_text, field_name, format_spec, conversion in parsed:
+        if field_name is not None and (format_spec or conversion or not field_name.isidentifier()):
+            return template.format
+        parts.append((literal_text, field_name))
+
+    def fill(**values):
+        return "".join(
+            literal_text if field_name is None else literal_text + str(values[field_name])
+            for literal_text, field_name in parts
+        )
+
+    return fill
+
+def _write_file_atomically(path, write):
+    """
+    Calls write(f) on a temporary file next to path, then renames it into place, so an
+    interrupted or failed write never leaves a truncated file at path. The temporary
+    file is removed if anything goes wrong.
+    """
+    tmp_path = f"{path}.{os.getpid()}.tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            write(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+def save_binary_file(path, data):
+    """
+    Writes bytes (e.g. a generated image) to path, replacing any existing file.
+
+    The write is atomic, so an interrupted run never leaves a truncated file that a
+    resumed run would take as finished.
+    """
+    _write_file_atomically(path, lambda f: f.write(data))
+
+def write_base64_file(path, b64_data, chunk_size=64 * 1024):
+    """
+    Decodes base64 data (e.g. an Images API b64_json field) straight into a file, a chunk at a time,
+    so the decoded image is never held in memory alongside its base64 text.
+
+    The write is atomic like save_binary_file, and invalid base64 raises binascii.Error
+    (a ValueError) instead of being skipped.
+    """
+    chunk_size -= chunk_size % 4 # Whole base64 quanta, so every slice decodes on its own
+    def write(f):
+        for start in range(0, len(b64_data), chunk_size):
+            f.write(base64.b64decode(b64_data[start:start + chunk_size], validate=True))
+    _write_file_atomically(path, write)
+
+def downscale_image_for_edit(path, max_side=1024):
+    """
+    Reads an image and re-encodes it as a PNG no larger than max_side on its longest edge.
+
+    Used for the reference image uploaded to the edit endpoint, which only needs to convey
+    composition and style; the edited result is still generated at the requested size.
+    """
+    with Image.open(path) as image:
+        image = image.convert("RGB")
+        image.thumbnail((max_side, max_side))
+        buffer = io.BytesIO()
+        image.save(buffer, format="PNG", optimize=True)
+    return buffer.getvalue()
+
+def build_character_matcher(characters):
+    """
+    Compiles one case-insensitive pattern that matches any character name as a whole word.
+
+    Returns a function that takes a scene description and returns the characters
+    mentioned in it (name -> description), in the original character order.
+    """
+    if not characters:
+        return lambda scene_description: {}
+
+    # Longest names first so "Leo Jr" is preferred over "Leo" at the same position
+    names = sorted(characters, key=len, reverse=True)
+    pattern = re.compile(
+        r"(?<!\w)(" + "|".join(re.escape(name) for name in names) + r")(?!\w)",
+        re.IGNORECASE
+    )
+    lowered_characters = [(name, name.lower(), desc) for name, desc in characters.items()]
+
+    def find_mentioned_characters(scene_description):
+        hits = {match.lower() for match in pattern.findall(scene_description)}
+        return {name: desc for name, lowered, desc in lowered_characters if lowered in hits}
+
+    return find_mentioned_characters
 
 def get_user_input(prompt_message, multi_line=False):
     """Gets input from the user, optionally allowing multi-line."""